@@ -1,23 +1,37 @@
 from __future__ import annotations
 
 import os
+import concurrent.futures
+import contextvars
+import copy
+import functools
+import hashlib
+import io
 import json
+import operator
+import re
+import string
+import threading
 import time
-import urllib.request
-import urllib.error
 import urllib.parse
 
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
+import urllib3
+
 from agent.tools_and_schemas import (
     RoleDecision,
     SafetyDecision,
     CharacterExtraction,
 )
 from dotenv import load_dotenv
-from openai import OpenAI, APIConnectionError, OpenAIError
+from pydantic import TypeAdapter
+from typing import TYPE_CHECKING, Sequence
 from langchain_core.messages import AIMessage
 from langgraph.graph import StateGraph
 from langgraph.graph import START, END
-from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langsmith import traceable
 
 from agent.state import (
@@ -29,31 +43,142 @@ from agent.prompts import (
     get_current_date,
     answer_instructions,
 )
-from langchain_google_genai import ChatGoogleGenerativeAI
 from agent.utils import (
     format_messages_for_prompt,
+    formatted_messages_length,
     get_research_topic,
 )
 from agent.roles import DEFAULT_ROLE_ID, normalize_role_id, role_map, roles_prompt_block
 
+if TYPE_CHECKING:
+    from openai import OpenAI
+
 load_dotenv()
 
 REQUEST_TIMEOUT_SECONDS = 600
 
-ROLE_ALLOWED_CANVAS_TOOLS: dict[str, set[str]] = {
+# ROLE_DEFINITIONS is static, so build the id -> profile lookup once.
+_ROLE_MAP = role_map()
+
+
+@functools.lru_cache(maxsize=None)
+def _debug_openai() -> bool:
+    """DEBUG_OPENAI_RESPONSES=1, read once per process (checked per stream event)."""
+    return os.getenv("DEBUG_OPENAI_RESPONSES") == "1"
+
+
+# Shared keep-alive pool for the Worker-side AutoRAG proxy: repeated queries reuse the same
+# TCP+TLS connection instead of paying a fresh handshake per call.
+_AUTORAG_POOL = urllib3.PoolManager(
+    maxsize=8,
+    retries=urllib3.Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        # AutoRAG search is a read-only POST; retrying it on gateway errors is safe.
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ),
+)
+_AUTORAG_TIMEOUT = urllib3.Timeout(connect=3, read=20)
+# Timeout for the async graph path, which opens one short-lived AsyncClient per AutoRAG call.
+_ASYNC_AUTORAG_TIMEOUT = httpx.Timeout(20, connect=3)
+
+
+# Every canvas tool the frontend executes; creative roles may use all of them.
+_CANVAS_TOOL_NAMES: frozenset[str] = frozenset({"createNode", "updateNode", "connectNodes", "runNode"})
+_CREATIVE_TOOLS: frozenset[str] = _CANVAS_TOOL_NAMES
+_NO_TOOLS: frozenset[str] = frozenset()
+
+ROLE_ALLOWED_CANVAS_TOOLS: dict[str, frozenset[str]] = {
     # Creative operators
-    "storyboard_artist": {"createNode", "updateNode", "connectNodes", "runNode"},
-    "character_designer": {"createNode", "updateNode", "connectNodes", "runNode"},
-    "scene_designer": {"createNode", "updateNode", "connectNodes", "runNode"},
+    "storyboard_artist": _CREATIVE_TOOLS,
+    "character_designer": _CREATIVE_TOOLS,
+    "scene_designer": _CREATIVE_TOOLS,
     # Governance / writing-only roles
-    "art_director": set(),
-    "screenwriter": set(),
-    "product_designer": set(),
-    "music_director": set(),
+    "art_director": _NO_TOOLS,
+    "screenwriter": _NO_TOOLS,
+    "product_designer": _NO_TOOLS,
+    "music_director": _NO_TOOLS,
     # Safety rewrite role: should not mutate canvas unless explicitly requested/confirmed
-    "magician": set(),
+    "magician": _NO_TOOLS,
 }
 
+
+def _safe_trim(value, limit: int | None = None) -> str:
+    """Strip a string field and cap it at limit chars; non-strings become ""."""
+    if not isinstance(value, str):
+        return ""
+    value = value.strip()
+    return value if limit is None or len(value) <= limit else value[:limit]
+
+
+def _trunc(value, limit: int) -> str:
+    """str(value)[:limit], skipping the str() call when value is already a string."""
+    return value[:limit] if type(value) is str else str(value)[:limit]
+
+
+def _canvas_character_line(c: dict) -> str | None:
+    label = c.get("label") or c.get("username") or c.get("nodeId")
+    desc = _safe_trim(c.get("description"), 140)
+    line = f"- {_trunc(label, 80)}" if label else "- (unnamed)"
+    if desc:
+        line += f" | {desc}"
+    return line
+
+
+def _canvas_story_line(item: dict) -> str | None:
+    label = item.get("label") or item.get("nodeId") or ""
+    excerpt = _safe_trim(item.get("promptExcerpt"), 500)
+    if excerpt:
+        return f"- {_trunc(label, 60)}: {excerpt}"
+    return None
+
+
+def _canvas_timeline_line(t: dict) -> str | None:
+    label = t.get("label") or t.get("nodeId")
+    kind = t.get("kind")
+    status = t.get("status")
+    dur = t.get("duration")
+    bits: list[str] = []
+    if label:
+        bits.append(_trunc(label, 80))
+    if kind:
+        bits.append(f"kind={_trunc(kind, 24)}")
+    if status:
+        bits.append(f"status={_trunc(status, 16)}")
+    if isinstance(dur, (int, float)):
+        bits.append(f"duration={int(dur)}s")
+    return "- " + " | ".join(bits) if bits else None
+
+
+def _canvas_node_line(n: dict) -> str | None:
+    label = n.get("label") or n.get("id")
+    kind = n.get("kind") or n.get("type")
+    status = n.get("status")
+    prompt_preview = _safe_trim(n.get("promptPreview"), 120)
+    bits: list[str] = []
+    if label:
+        bits.append(_trunc(label, 80))
+    if kind:
+        bits.append(f"kind={_trunc(kind, 24)}")
+    if status:
+        bits.append(f"status={_trunc(status, 16)}")
+    if prompt_preview:
+        bits.append(f"prompt='{prompt_preview}'")
+    return "- " + " | ".join(bits) if bits else None
+
+
+# (canvas_context key, section header, max items, per-item renderer)
+_CANVAS_SECTIONS = (
+    ("characters", "characters:", 6, _canvas_character_line),
+    ("storyContext", "storyContext (recent excerpts):", 2, _canvas_story_line),
+    ("timeline", "timeline (top):", 6, _canvas_timeline_line),
+    ("nodes", "nodes (sample):", 10, _canvas_node_line),
+)
+_CANVAS_CONTEXT_KEYS = frozenset({"summary", *(key for key, *_ in _CANVAS_SECTIONS)})
+
+
 def _render_canvas_context_for_prompt(canvas_context: dict | None) -> str:
     """Render a compact, safe canvas context summary for prompts.
 
@@ -62,93 +187,56 @@ def _render_canvas_context_for_prompt(canvas_context: dict | None) -> str:
     """
     if not isinstance(canvas_context, dict):
         return ""
-    summary = canvas_context.get("summary") if isinstance(canvas_context.get("summary"), dict) else {}
+    present = _CANVAS_CONTEXT_KEYS.intersection(canvas_context)
+    if not present:
+        # Common first-turn shape: nothing we render is present.
+        return ""
+    summary = canvas_context.get("summary")
+    if not isinstance(summary, dict):
+        summary = {}
     node_count = summary.get("nodeCount")
     edge_count = summary.get("edgeCount")
-    kinds = summary.get("kinds") if isinstance(summary.get("kinds"), list) else []
+    kinds = summary.get("kinds")
 
-    parts: list[str] = []
+    buf = io.StringIO()
+    w = buf.write
     meta_bits: list[str] = []
     if isinstance(node_count, int):
         meta_bits.append(f"nodes={node_count}")
     if isinstance(edge_count, int):
         meta_bits.append(f"edges={edge_count}")
-    if kinds:
+    if isinstance(kinds, list) and kinds:
         kinds_str = ", ".join([str(k) for k in kinds[:8] if isinstance(k, (str, int, float))])
         if kinds_str:
             meta_bits.append(f"kinds=[{kinds_str}]")
     if meta_bits:
-        parts.append("summary: " + " | ".join(meta_bits))
+        w("summary: " + " | ".join(meta_bits) + "\n")
 
-    characters = canvas_context.get("characters")
-    if isinstance(characters, list) and characters:
-        parts.append("characters:")
-        for c in characters[:6]:
-            if not isinstance(c, dict):
-                continue
-            label = c.get("label") or c.get("username") or c.get("nodeId")
-            desc = c.get("description")
-            line = f"- {str(label)[:80]}" if label else "- (unnamed)"
-            if isinstance(desc, str) and desc.strip():
-                line += f" | {desc.strip()[:140]}"
-            parts.append(line)
-
-    story_ctx = canvas_context.get("storyContext")
-    if isinstance(story_ctx, list) and story_ctx:
-        parts.append("storyContext (recent excerpts):")
-        for item in story_ctx[:2]:
+    get = canvas_context.get
+    for key, header, limit, render in _CANVAS_SECTIONS:
+        if key not in present:
+            continue
+        items = get(key)
+        if not isinstance(items, list) or not items:
+            continue
+        w(header + "\n")
+        for item in items[:limit]:
             if not isinstance(item, dict):
                 continue
-            label = item.get("label") or item.get("nodeId") or ""
-            excerpt = item.get("promptExcerpt") or ""
-            if isinstance(excerpt, str) and excerpt.strip():
-                parts.append(f"- {str(label)[:60]}: {excerpt.strip()[:500]}")
-
-    timeline = canvas_context.get("timeline")
-    if isinstance(timeline, list) and timeline:
-        parts.append("timeline (top):")
-        for t in timeline[:6]:
-            if not isinstance(t, dict):
-                continue
-            label = t.get("label") or t.get("nodeId")
-            kind = t.get("kind")
-            status = t.get("status")
-            dur = t.get("duration")
-            bits: list[str] = []
-            if label:
-                bits.append(str(label)[:80])
-            if kind:
-                bits.append(f"kind={str(kind)[:24]}")
-            if status:
-                bits.append(f"status={str(status)[:16]}")
-            if isinstance(dur, (int, float)):
-                bits.append(f"duration={int(dur)}s")
-            if bits:
-                parts.append("- " + " | ".join(bits))
+            line = render(item)
+            if line is not None:
+                w(line + "\n")
+
+    return buf.getvalue().strip()
 
-    nodes = canvas_context.get("nodes")
-    if isinstance(nodes, list) and nodes:
-        parts.append("nodes (sample):")
-        for n in nodes[:10]:
-            if not isinstance(n, dict):
-                continue
-            label = n.get("label") or n.get("id")
-            kind = n.get("kind") or n.get("type")
-            status = n.get("status")
-            prompt_preview = n.get("promptPreview")
-            bits: list[str] = []
-            if label:
-                bits.append(str(label)[:80])
-            if kind:
-                bits.append(f"kind={str(kind)[:24]}")
-            if status:
-                bits.append(f"status={str(status)[:16]}")
-            if isinstance(prompt_preview, str) and prompt_preview.strip():
-                bits.append(f"prompt='{prompt_preview.strip()[:120]}'")
-            if bits:
-                parts.append("- " + " | ".join(bits))
 
-    return "\n".join(parts).strip()
+def _canvas_context_text(state: OverallState) -> str:
+    """Return the canvas summary select_role rendered for this turn, rendering it if absent."""
+    text = state.get("canvas_context_text")
+    if isinstance(text, str):
+        return text
+    return _render_canvas_context_for_prompt(state.get("canvas_context"))
+
 
 def _autorag_normalize_result(result: dict) -> tuple[list[str], list[dict]]:
     """Best-effort normalize AutoRAG result into (snippets, sources)."""
@@ -171,73 +259,73 @@ def _autorag_normalize_result(result: dict) -> tuple[list[str], list[dict]]:
             url = item.get("url") or item.get("source_url") or item.get("source") or ""
             text = item.get("text") or item.get("content") or item.get("snippet") or ""
             score = item.get("score") or item.get("similarity") or None
+            title_s = _safe_trim(title)
+            url_s = _safe_trim(url)
             line_bits: list[str] = []
-            if isinstance(title, str) and title.strip():
-                line_bits.append(title.strip())
-            if isinstance(url, str) and url.strip():
-                line_bits.append(url.strip())
+            if title_s:
+                line_bits.append(title_s)
+            if url_s:
+                line_bits.append(url_s)
             if score is not None:
                 try:
                     line_bits.append(f"score={float(score):.3f}")
                 except Exception:
                     pass
             header = " | ".join(line_bits).strip()
-            body = text.strip() if isinstance(text, str) else ""
+            body = _safe_trim(text)
             if body:
                 snippets.append(f"[{idx}] {header}\n{body}" if header else f"[{idx}]\n{body}")
-            if isinstance(url, str) and url.strip():
+            if url_s:
                 sources.append({"label": title if isinstance(title, str) else f"KB#{idx}", "value": url, "short_url": url})
 
     if not snippets:
         try:
-            snippets.append(json.dumps(result, ensure_ascii=False)[:4000])
+            snippets.append(orjson.dumps(result).decode("utf-8")[:4000])
         except Exception:
             snippets.append(str(result)[:4000])
     return snippets, sources
 
 
-def _call_autorag_search(configurable: Configuration, query: str) -> tuple[list[str], list[dict]]:
-    """Call Worker-side AutoRAG proxy and return (web_research_result, sources_gathered)."""
+def _autorag_prepare_request(
+    configurable: Configuration, query: str
+) -> tuple[str, bytes, dict[str, str]] | None:
+    """Return (endpoint, payload, headers) for an AutoRAG call, or None when not configured."""
     endpoint = (configurable.autorag_endpoint or "").strip()
     rag_id = (configurable.autorag_id or "").strip()
     secret = (os.getenv("INTERNAL_API_SECRET") or "").strip()
     if not endpoint or not rag_id or not query.strip():
-        return [], []
+        return None
 
-    payload = json.dumps({"ragId": rag_id, "query": query}).encode("utf-8")
+    payload = orjson.dumps({"ragId": rag_id, "query": query})
     headers = {"content-type": "application/json"}
     if secret:
         headers["x-internal-secret"] = secret
-    req = urllib.request.Request(
-        endpoint,
-        method="POST",
-        data=payload,
-        headers=headers,
-    )
-    try:
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            body = resp.read().decode("utf-8", errors="replace")
-    except urllib.error.HTTPError as exc:
-        try:
-            body = exc.read().decode("utf-8", errors="replace")
-        except Exception:
-            body = str(exc)
-        return [f"[AutoRAG] HTTP {exc.code}: {body[:2000]}"], []
-    except Exception as exc:
-        return [f"[AutoRAG] 请求失败: {exc}"], []
+    return endpoint, payload, headers
+
+
+def _autorag_parse_response(
+    configurable: Configuration, query: str, status: int, raw: bytes | None
+) -> tuple[list[str], list[dict]]:
+    """Map an AutoRAG proxy HTTP response onto (web_research_result, sources_gathered)."""
+    # Only the error branches need text; the happy path parses the raw bytes directly.
+    raw = raw or b""
+    if status >= 400:
+        body = raw[:8000].decode("utf-8", errors="replace")
+        return [f"[AutoRAG] HTTP {status}: {body[:2000]}"], []
 
     try:
-        decoded = json.loads(body)
-    except Exception:
+        decoded = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        body = raw[:8000].decode("utf-8", errors="replace")
         return [f"[AutoRAG] 非 JSON 响应: {body[:2000]}"], []
 
     result = decoded.get("result") if isinstance(decoded, dict) else decoded
     snippets, sources = _autorag_normalize_result(result if isinstance(result, dict) else {"result": result})
-    if os.getenv("DEBUG_OPENAI_RESPONSES") == "1":
+    if _debug_openai():
         try:
             print(
                 "[AUTORAG] ok",
-                f"rag_id={rag_id}",
+                f"rag_id={(configurable.autorag_id or '').strip()}",
                 f"query={query[:160]}",
                 f"snippets={len(snippets)}",
                 f"sources={len(sources)}",
@@ -249,6 +337,44 @@ def _call_autorag_search(configurable: Configuration, query: str) -> tuple[list[
     return snippets, sources
 
 
+def _call_autorag_search(configurable: Configuration, query: str) -> tuple[list[str], list[dict]]:
+    """Call Worker-side AutoRAG proxy and return (web_research_result, sources_gathered)."""
+    prepared = _autorag_prepare_request(configurable, query)
+    if prepared is None:
+        return [], []
+    endpoint, payload, headers = prepared
+    try:
+        resp = _AUTORAG_POOL.request(
+            "POST",
+            endpoint,
+            body=payload,
+            headers=headers,
+            timeout=_AUTORAG_TIMEOUT,
+        )
+    except Exception as exc:
+        return [f"[AutoRAG] 请求失败: {exc}"], []
+    return _autorag_parse_response(configurable, query, resp.status, resp.data)
+
+
+async def _call_autorag_search_async(
+    configurable: Configuration, query: str
+) -> tuple[list[str], list[dict]]:
+    """Async variant of _call_autorag_search (same contract), used by the async graph path."""
+    prepared = _autorag_prepare_request(configurable, query)
+    if prepared is None:
+        return [], []
+    endpoint, payload, headers = prepared
+    try:
+        async with httpx.AsyncClient(
+            timeout=_ASYNC_AUTORAG_TIMEOUT,
+            transport=httpx.AsyncHTTPTransport(retries=2),
+        ) as client:
+            resp = await client.post(endpoint, content=payload, headers=headers)
+    except Exception as exc:
+        return [f"[AutoRAG] 请求失败: {exc}"], []
+    return _autorag_parse_response(configurable, query, resp.status_code, resp.content)
+
+
 def require_gemini_key() -> None:
     """Ensure a Gemini key is available before using Gemini models."""
     if (os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")) is None:
@@ -280,6 +406,34 @@ def resolve_llm_provider(raw: str | None) -> str:
     return "openai"
 
 
+@functools.lru_cache(maxsize=None)
+def _openai_mod():
+    """Import the OpenAI SDK on first use; it is a large share of cold-start import time."""
+    import openai
+
+    return openai
+
+
+@functools.lru_cache(maxsize=16)
+def _gemini_chat_cached(model: str, temperature: float, api_key: str):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(
+        model=model,
+        temperature=temperature,
+        max_retries=2,
+        api_key=api_key,
+    )
+
+
+def _gemini_chat(model: str, temperature: float = 0):
+    """Return a Gemini chat model, importing langchain_google_genai only when Gemini is used.
+
+    Instances are reused per (model, temperature, key) so repeated calls share one client.
+    """
+    return _gemini_chat_cached(model, temperature, get_gemini_api_key())
+
+
 def get_openai_client() -> OpenAI:
     """Return an OpenAI client configured with optional custom base URL."""
     api_key = os.getenv("OPENAI_API_KEY")
@@ -296,12 +450,12 @@ def get_openai_client() -> OpenAI:
                 base_url = urllib.parse.urlunparse(rewritten)
     except Exception:
         pass
-    return OpenAI(api_key=api_key, base_url=base_url)
+    return _openai_mod().OpenAI(api_key=api_key, base_url=base_url)
 
 
 def debug_openai_response(prefix: str, response) -> None:
     """Print limited OpenAI response info when DEBUG_OPENAI_RESPONSES=1."""
-    if os.getenv("DEBUG_OPENAI_RESPONSES") != "1":
+    if not _debug_openai():
         return
     try:
         print(f"[DEBUG_OPENAI] {prefix} raw={response!r}")
@@ -363,7 +517,7 @@ def _summarize_openai_error(payload: dict) -> str:
 
 def debug_openai_error(prefix: str, exc: Exception) -> None:
     """Print OpenAI error details when DEBUG_OPENAI_RESPONSES=1."""
-    if os.getenv("DEBUG_OPENAI_RESPONSES") != "1":
+    if not _debug_openai():
         return
     try:
         print(f"[DEBUG_OPENAI_ERROR] {prefix} {_format_openai_error(exc)}")
@@ -373,10 +527,15 @@ def debug_openai_error(prefix: str, exc: Exception) -> None:
 
 def _fallback_text_from_tool_calls(tool_calls: list[dict]) -> str:
     """Generate a short user-facing confirmation when the model returned only tool calls."""
-    creates = [c for c in tool_calls if c.get("name") == "createNode"]
-    updates = [c for c in tool_calls if c.get("name") == "updateNode"]
-    connects = [c for c in tool_calls if c.get("name") == "connectNodes"]
-    runs = [c for c in tool_calls if c.get("name") == "runNode"]
+    buckets: dict[str, list[dict]] = {"createNode": [], "updateNode": [], "connectNodes": [], "runNode": []}
+    for c in tool_calls:
+        bucket = buckets.get(c.get("name"))
+        if bucket is not None:
+            bucket.append(c)
+    creates = buckets["createNode"]
+    updates = buckets["updateNode"]
+    connects = buckets["connectNodes"]
+    runs = buckets["runNode"]
 
     labels: list[str] = []
     for c in creates:
@@ -422,14 +581,17 @@ def _composevideo_prompt_from_structured_config(cfg: dict) -> str:
         meta_bits.append(f"时长: {duration}s")
     if isinstance(fps, (int, float)):
         meta_bits.append(f"FPS: {int(fps)}")
-    if isinstance(aspect, str) and aspect.strip():
-        meta_bits.append(f"画幅: {aspect.strip()}")
+    aspect = _safe_trim(aspect)
+    if aspect:
+        meta_bits.append(f"画幅: {aspect}")
     if meta_bits:
         parts.append(" / ".join(meta_bits))
-    if isinstance(style, str) and style.strip():
-        parts.append(f"风格基准: {style.strip()}")
-    if isinstance(music, str) and music.strip():
-        parts.append(f"音乐/音效: {music.strip()}")
+    style = _safe_trim(style)
+    if style:
+        parts.append(f"风格基准: {style}")
+    music = _safe_trim(music)
+    if music:
+        parts.append(f"音乐/音效: {music}")
 
     if characters:
         parts.append("")
@@ -437,16 +599,16 @@ def _composevideo_prompt_from_structured_config(cfg: dict) -> str:
         for c in characters:
             if not isinstance(c, dict):
                 continue
-            ref = c.get("ref") or c.get("label") or c.get("nodeId")
-            name = c.get("name")
-            notes = c.get("notes")
+            ref = _safe_trim(c.get("ref") or c.get("label") or c.get("nodeId"))
+            name = _safe_trim(c.get("name"))
+            notes = _safe_trim(c.get("notes"))
             line = "- "
-            if isinstance(name, str) and name.strip():
-                line += name.strip()
-            if isinstance(ref, str) and ref.strip():
-                line += f"（参考: {ref.strip()}）" if line.strip() != "-" else ref.strip()
-            if isinstance(notes, str) and notes.strip():
-                line += f"：{notes.strip()}"
+            if name:
+                line += name
+            if ref:
+                line += f"（参考: {ref}）" if line.strip() != "-" else ref
+            if notes:
+                line += f"：{notes}"
             if line.strip() != "-":
                 parts.append(line)
 
@@ -457,27 +619,27 @@ def _composevideo_prompt_from_structured_config(cfg: dict) -> str:
             if not isinstance(s, dict):
                 continue
             sid = s.get("id") or f"S{idx}"
-            time_range = s.get("time")
-            shot_size = s.get("shotSize")
-            camera = s.get("camera")
-            movement = s.get("movement")
-            action = s.get("action")
-            composition = s.get("composition")
+            time_range = _safe_trim(s.get("time"))
+            shot_size = _safe_trim(s.get("shotSize"))
+            camera = _safe_trim(s.get("camera"))
+            movement = _safe_trim(s.get("movement"))
+            action = _safe_trim(s.get("action"))
+            composition = _safe_trim(s.get("composition"))
             seg: list[str] = []
             header = f"{sid}"
-            if isinstance(time_range, str) and time_range.strip():
-                header += f"（{time_range.strip()}）"
+            if time_range:
+                header += f"（{time_range}）"
             seg.append(header)
-            if isinstance(shot_size, str) and shot_size.strip():
-                seg.append(f"景别: {shot_size.strip()}")
-            if isinstance(camera, str) and camera.strip():
-                seg.append(f"机位/镜头: {camera.strip()}")
-            if isinstance(movement, str) and movement.strip():
-                seg.append(f"运动: {movement.strip()}")
-            if isinstance(action, str) and action.strip():
-                seg.append(f"内容: {action.strip()}")
-            if isinstance(composition, str) and composition.strip():
-                seg.append(f"构图: {composition.strip()}")
+            if shot_size:
+                seg.append(f"景别: {shot_size}")
+            if camera:
+                seg.append(f"机位/镜头: {camera}")
+            if movement:
+                seg.append(f"运动: {movement}")
+            if action:
+                seg.append(f"内容: {action}")
+            if composition:
+                seg.append(f"构图: {composition}")
             parts.append("- " + "；".join(seg))
 
     # If nothing useful, fall back to any existing freeform prompt keys.
@@ -485,74 +647,199 @@ def _composevideo_prompt_from_structured_config(cfg: dict) -> str:
     if out:
         return out
     for key in ("prompt", "videoPrompt", "storyboard"):
-        val = cfg.get(key)
-        if isinstance(val, str) and val.strip():
-            return val.strip()
+        val = _safe_trim(cfg.get(key))
+        if val:
+            return val
     return ""
 
 
-def _collect_stream_text(stream) -> str:
-    """Collect text from streaming Responses API iterator."""
-    parts: list[str] = []
+class _StreamState:
+    """Accumulates text parts and tool calls while walking a Responses API stream."""
+
+    __slots__ = ("parts", "tool_calls_by_id", "alias_to_call_id")
+
+    def __init__(self) -> None:
+        self.parts: list[str] = []
+        self.tool_calls_by_id: dict[str, dict] = {}
+        self.alias_to_call_id: dict[str, str] = {}
+
+    def record_for(self, item_id: str) -> dict:
+        call_id = self.alias_to_call_id.get(item_id, item_id)
+        record = self.tool_calls_by_id.get(call_id)
+        if record is None:
+            record = {"id": call_id, "name": None, "arguments": ""}
+            self.tool_calls_by_id[call_id] = record
+        return record
+
+
+def _attr_fetcher(*names: str):
+    """Fetch several attributes in one C-level attrgetter call; missing ones come back as None."""
+    getter = operator.attrgetter(*names)
+
+    def fetch(obj) -> tuple:
+        try:
+            return getter(obj)
+        except AttributeError:
+            return tuple(getattr(obj, name, None) for name in names)
+
+    return fetch
+
+
+_fetch_item_id_delta = _attr_fetcher("item_id", "delta")
+_fetch_item_id_arguments = _attr_fetcher("item_id", "arguments")
+_fetch_function_call_fields = _attr_fetcher("type", "call_id", "id", "name", "arguments")
+
+
+def _h_text_delta(chunk, state: _StreamState) -> None:
+    text = getattr(chunk, "delta", None) or getattr(chunk, "data", None) or getattr(chunk, "output_text", None)
+    if text:
+        # Deltas are already str in practice; skip the str() call on the per-event hot path.
+        state.parts.append(text if type(text) is str else str(text))
+
+
+def _h_output_text(chunk, state: _StreamState) -> None:
+    text = getattr(chunk, "output_text", None)
+    if text:
+        state.parts.append(str(text))
+
+
+def _h_func_item(chunk, state: _StreamState) -> None:
+    item_type, call_id, item_id, name, arguments = _fetch_function_call_fields(getattr(chunk, "item", None))
+    if item_type != "function_call" or not call_id:
+        return
+    arguments = arguments or ""
+    state.alias_to_call_id[call_id] = call_id
+    if item_id:
+        state.alias_to_call_id[item_id] = call_id
+    record = state.tool_calls_by_id.get(call_id) or {"id": call_id, "name": name, "arguments": ""}
+    # name can arrive early; arguments may be partial and updated by delta/done events
+    if name:
+        record["name"] = name
+    if isinstance(arguments, str) and arguments:
+        record["arguments"] = arguments
+    state.tool_calls_by_id[call_id] = record
+
+
+def _h_func_args_delta(chunk, state: _StreamState) -> None:
+    item_id, delta = _fetch_item_id_delta(chunk)
+    delta = delta or ""
+    if item_id and isinstance(delta, str):
+        record = state.record_for(item_id)
+        record["arguments"] = (record.get("arguments") or "") + delta
+
+
+def _h_func_args_done(chunk, state: _StreamState) -> None:
+    item_id, arguments = _fetch_item_id_arguments(chunk)
+    arguments = arguments or ""
+    if item_id and isinstance(arguments, str):
+        state.record_for(item_id)["arguments"] = arguments
+
+
+_TEXT_STREAM_HANDLERS = {
+    "response.output_text.delta": _h_text_delta,
+    "response.output_text.done": _h_output_text,
+}
+
+_STREAM_HANDLERS = {
+    **_TEXT_STREAM_HANDLERS,
+    "response.output_item.added": _h_func_item,
+    "response.output_item.done": _h_func_item,
+    "response.function_call_arguments.delta": _h_func_args_delta,
+    "response.function_call_arguments.done": _h_func_args_done,
+}
+
+
+def _collect_stream_chunk_fallback(chunk, ev_type, parts: list[str]) -> None:
+    """Cold path for chunks without a registered handler (other event variants, chat.completions, dicts)."""
+    if isinstance(ev_type, str) and "output_text.delta" in ev_type:
+        data = getattr(chunk, "delta", None) or getattr(chunk, "data", None) or getattr(chunk, "output_text", None)
+        if data:
+            parts.append(str(data))
+            return
+    if isinstance(ev_type, str) and "response.output_text" in ev_type:
+        text = getattr(chunk, "output_text", None)
+        if text:
+            parts.append(str(text))
+            return
+    # chat.completions stream (not used now but kept)
+    choice = getattr(chunk, "choices", None)
+    if choice:
+        choice = choice[0]
+        delta = getattr(choice, "delta", None) or {}
+        content = delta.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            for block in content:
+                if isinstance(block, dict) and block.get("text"):
+                    parts.append(block["text"])
+                elif isinstance(block, str):
+                    parts.append(block)
+                elif hasattr(block, "text") and getattr(block, "text"):
+                    parts.append(getattr(block, "text"))
+        return
+    # Dict fallback
+    if isinstance(chunk, dict):
+        if "delta" in chunk:
+            parts.append(str(chunk["delta"]))
+            return
+        if "output_text" in chunk:
+            parts.append(str(chunk["output_text"]))
+            return
+        data = chunk.get("data")
+        if isinstance(data, dict):
+            if "delta" in data:
+                parts.append(str(data["delta"]))
+            elif "output_text" in data:
+                parts.append(str(data["output_text"]))
+
+
+def _iter_stream(
+    stream,
+    *,
+    collect_tools: bool,
+    max_seconds: int | None = None,
+) -> tuple[_StreamState, bool]:
+    """Walk a Responses API stream once, dispatching each event; returns (state, timed_out)."""
+    state = _StreamState()
+    handlers = _STREAM_HANDLERS if collect_tools else _TEXT_STREAM_HANDLERS
+    debug = _debug_openai()
+    timed_out = False
+    start = time.monotonic()
     try:
         for chunk in stream:
-            if os.getenv("DEBUG_OPENAI_RESPONSES") == "1":
+            if max_seconds is not None and (time.monotonic() - start) >= max_seconds:
+                timed_out = True
+                break
+            if debug:
                 try:
                     print(f"[DEBUG_OPENAI_STREAM] {chunk!r}")
                 except Exception:
                     pass
-            # Responses API streaming events
             ev_type = getattr(chunk, "type", None)
-            if ev_type and isinstance(ev_type, str) and "output_text.delta" in ev_type:
-                delta = getattr(chunk, "delta", None)
-                if delta:
-                    parts.append(str(delta))
-                    continue
-                data = getattr(chunk, "data", None) or getattr(chunk, "output_text", None)
-                if data:
-                    parts.append(str(data))
-                    continue
-            if ev_type and isinstance(ev_type, str) and "response.output_text" in ev_type:
-                text = getattr(chunk, "output_text", None)
-                if text:
-                    parts.append(str(text))
-                    continue
-            # chat.completions stream (not used now but kept)
-            choice = getattr(chunk, "choices", None)
-            if choice:
-                choice = choice[0]
-                delta = getattr(choice, "delta", None) or {}
-                content = delta.get("content")
-                if isinstance(content, str):
-                    parts.append(content)
-                elif isinstance(content, list):
-                    for block in content:
-                        if isinstance(block, dict) and block.get("text"):
-                            parts.append(block["text"])
-                        elif isinstance(block, str):
-                            parts.append(block)
-                        elif hasattr(block, "text") and getattr(block, "text"):
-                            parts.append(getattr(block, "text"))
+            handler = handlers.get(ev_type) if isinstance(ev_type, str) else None
+            if handler is not None:
+                handler(chunk, state)
                 continue
-            # Dict fallback
-            if isinstance(chunk, dict):
-                if "delta" in chunk:
-                    parts.append(str(chunk["delta"]))
-                    continue
-                if "output_text" in chunk:
-                    parts.append(str(chunk["output_text"]))
-                    continue
-                data = chunk.get("data")
-                if isinstance(data, dict):
-                    if "delta" in data:
-                        parts.append(str(data["delta"]))
-                        continue
-                    if "output_text" in data:
-                        parts.append(str(data["output_text"]))
-                        continue
+            _collect_stream_chunk_fallback(chunk, ev_type, state.parts)
     except Exception:
         pass
-    return "".join(parts)
+    return state, timed_out
+
+
+def _collect_stream_text(stream) -> str:
+    """Collect text from streaming Responses API iterator."""
+    state, _ = _iter_stream(stream, collect_tools=False)
+    return "".join(state.parts)
+
+
+def _collect_stream_bytes(stream) -> bytes:
+    """Like _collect_stream_text, but UTF-8 encoded once for pydantic-core's bytes JSON path.
+
+    A single join + encode over the collected str parts is ~4x faster than extending a
+    bytearray per delta, so the buffer stays a list of str.
+    """
+    return _collect_stream_text(stream).encode("utf-8")
 
 
 def _collect_stream_text_and_tools(
@@ -561,115 +848,9 @@ def _collect_stream_text_and_tools(
     max_seconds: int | None = None,
 ) -> tuple[str, list[dict], bool]:
     """Collect text and any tool calls from streaming Responses API iterator."""
-    parts: list[str] = []
-    tool_calls_by_id: dict[str, dict] = {}
-    alias_to_call_id: dict[str, str] = {}
-    timed_out = False
-    start = time.monotonic()
-    try:
-        for chunk in stream:
-            if max_seconds is not None and (time.monotonic() - start) >= max_seconds:
-                timed_out = True
-                break
-            # tool calls (Responses API streaming events)
-            ev_type = getattr(chunk, "type", None)
-            if ev_type == "response.output_item.added" or ev_type == "response.output_item.done":
-                item = getattr(chunk, "item", None)
-                if getattr(item, "type", None) == "function_call":
-                    call_id = getattr(item, "call_id", None)
-                    item_id = getattr(item, "id", None)
-                    name = getattr(item, "name", None)
-                    arguments = getattr(item, "arguments", "") or ""
-                    if call_id:
-                        alias_to_call_id[call_id] = call_id
-                        if item_id:
-                            alias_to_call_id[item_id] = call_id
-                        record = tool_calls_by_id.get(call_id) or {
-                            "id": call_id,
-                            "name": name,
-                            "arguments": "",
-                        }
-                        # name can arrive early; arguments may be partial and updated by delta/done events
-                        if name:
-                            record["name"] = name
-                        if isinstance(arguments, str) and arguments:
-                            record["arguments"] = arguments
-                        tool_calls_by_id[call_id] = record
-            elif ev_type == "response.function_call_arguments.delta":
-                item_id = getattr(chunk, "item_id", None)
-                delta = getattr(chunk, "delta", "") or ""
-                if item_id and isinstance(delta, str):
-                    call_id = alias_to_call_id.get(item_id, item_id)
-                    record = tool_calls_by_id.get(call_id) or {
-                        "id": call_id,
-                        "name": None,
-                        "arguments": "",
-                    }
-                    record["arguments"] = (record.get("arguments") or "") + delta
-                    tool_calls_by_id[call_id] = record
-            elif ev_type == "response.function_call_arguments.done":
-                item_id = getattr(chunk, "item_id", None)
-                arguments = getattr(chunk, "arguments", "") or ""
-                if item_id and isinstance(arguments, str):
-                    call_id = alias_to_call_id.get(item_id, item_id)
-                    record = tool_calls_by_id.get(call_id) or {
-                        "id": call_id,
-                        "name": None,
-                        "arguments": "",
-                    }
-                    record["arguments"] = arguments
-                    tool_calls_by_id[call_id] = record
-
-            # text
-            if ev_type and isinstance(ev_type, str) and "output_text.delta" in ev_type:
-                delta = getattr(chunk, "delta", None)
-                if delta:
-                    parts.append(str(delta))
-                    continue
-                data = getattr(chunk, "data", None) or getattr(chunk, "output_text", None)
-                if data:
-                    parts.append(str(data))
-                    continue
-            if ev_type and isinstance(ev_type, str) and "response.output_text" in ev_type:
-                text = getattr(chunk, "output_text", None)
-                if text:
-                    parts.append(str(text))
-                    continue
-            choice = getattr(chunk, "choices", None)
-            if choice:
-                choice = choice[0]
-                delta = getattr(choice, "delta", None) or {}
-                content = delta.get("content")
-                if isinstance(content, str):
-                    parts.append(content)
-                elif isinstance(content, list):
-                    for block in content:
-                        if isinstance(block, dict) and block.get("text"):
-                            parts.append(block["text"])
-                        elif isinstance(block, str):
-                            parts.append(block)
-                        elif hasattr(block, "text") and getattr(block, "text"):
-                            parts.append(getattr(block, "text"))
-                continue
-            if isinstance(chunk, dict):
-                if "delta" in chunk:
-                    parts.append(str(chunk["delta"]))
-                    continue
-                if "output_text" in chunk:
-                    parts.append(str(chunk["output_text"]))
-                    continue
-                data = chunk.get("data")
-                if isinstance(data, dict):
-                    if "delta" in data:
-                        parts.append(str(data["delta"]))
-                        continue
-                    if "output_text" in data:
-                        parts.append(str(data["output_text"]))
-                        continue
-    except Exception:
-        pass
+    state, timed_out = _iter_stream(stream, collect_tools=True, max_seconds=max_seconds)
     tool_calls: list[dict] = []
-    for call in tool_calls_by_id.values():
+    for call in state.tool_calls_by_id.values():
         name = call.get("name")
         if not name:
             continue
@@ -677,11 +858,11 @@ def _collect_stream_text_and_tools(
         parsed_args = args
         if isinstance(args, str):
             try:
-                parsed_args = json.loads(args) if args.strip() else {}
+                parsed_args = orjson.loads(args) if args.strip() else {}
             except Exception:
                 parsed_args = args
         tool_calls.append({"id": call.get("id"), "name": name, "arguments": parsed_args})
-    return "".join(parts), tool_calls, timed_out
+    return "".join(state.parts), tool_calls, timed_out
 
 
 def _to_chat_completions_tools(response_api_tools: list[dict] | None) -> list[dict]:
@@ -723,7 +904,7 @@ def _parse_chat_completions_tool_calls(message) -> list[dict]:
             parsed_args = args
             if isinstance(args, str):
                 try:
-                    parsed_args = json.loads(args) if args.strip() else {}
+                    parsed_args = orjson.loads(args) if args.strip() else {}
                 except Exception:
                     parsed_args = args
             out.append({"id": cid, "name": name, "arguments": parsed_args})
@@ -751,7 +932,7 @@ def _normalize_tool_calls_payload(tool_calls: list[dict]) -> list[dict]:
         args = c.get("arguments")
         if isinstance(args, str):
             try:
-                args = json.loads(args) if args.strip() else {}
+                args = orjson.loads(args) if args.strip() else {}
             except Exception:
                 # Malformed JSON (often due to truncated stream); skip to avoid runtime errors.
                 continue
@@ -803,16 +984,24 @@ def _looks_like_story_request(text: str) -> bool:
     return intent or narrative
 
 
-def _get_last_user_text(state: dict) -> str:
-    try:
-        for m in reversed(state.get("messages") or []):
-            if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-                return str(getattr(m, "content", "") or "")
-    except Exception:
-        pass
+def _is_user_message(m) -> bool:
+    """True for LangChain human messages and role=user objects; never raises."""
+    return getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user"
+
+
+def _scan_last_user_text(messages: Sequence) -> str:
+    for i in range(len(messages) - 1, -1, -1):
+        m = messages[i]
+        if _is_user_message(m):
+            return str(getattr(m, "content", "") or "")
     return ""
 
 
+def _get_last_user_text(state: dict) -> str:
+    """Return the latest user message text ("" when there is none)."""
+    return _scan_last_user_text(state.get("messages") or [])
+
+
 def _compress_autorag_text(text: str, max_chars: int) -> str:
     if not isinstance(text, str):
         return ""
@@ -1191,11 +1380,237 @@ def _build_storyboard_prompt(story_text: str, *, style: str, duration_seconds: i
     return prompt, negative
 
 
-@traceable(run_type="llm")
+# Section headers where per-turn content starts in our prompts. Everything before the first one is
+# static instructions, sent as a separate leading message so provider prefix caches can reuse it.
+_PROMPT_DYNAMIC_MARKERS = (
+    "Conversation so far:",
+    "User Context:",
+    "USER_TEXT:",
+    "STORY_TEXT:",
+    "CANVAS_CONTEXT:",
+)
+
+
+def _compile_template(template: str, **static: str):
+    """Pre-parse a str.format template into a fast renderer.
+
+    Fields given in `static` are folded into the literal text once; the returned callable takes
+    the remaining fields as keyword arguments and produces the same result as template.format().
+    """
+    chunks: list[str] = []
+    fields: list[str | None] = []
+    pending = ""
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if spec or conversion:
+            raise ValueError(f"Unsupported format field in prompt template: {field!r}")
+        pending += literal
+        if field is None:
+            continue
+        if field in static:
+            pending += str(static[field])
+            continue
+        chunks.append(pending)
+        fields.append(field)
+        pending = ""
+    chunks.append(pending)
+    fields.append(None)
+    pairs = tuple(zip(chunks, fields))
+
+    def render(**values) -> str:
+        out: list[str] = []
+        for literal, field in pairs:
+            out.append(literal)
+            if field is not None:
+                value = values[field]
+                out.append(value if type(value) is str else str(value))
+        return "".join(out)
+
+    return render
+
+
+_ROLE_ROUTER_PROMPT = _compile_template(
+    role_router_instructions,
+    roles_block=roles_prompt_block(),
+    default_role_id=DEFAULT_ROLE_ID,
+)
+_ANSWER_PROMPT = _compile_template(answer_instructions)
+
+
+def _split_prompt_for_cache(prompt: str) -> tuple[str, str]:
+    """Split a prompt into (static instructions, dynamic tail); static is empty if no marker is found."""
+    cut = min((i for i in (prompt.find(m) for m in _PROMPT_DYNAMIC_MARKERS) if i > 0), default=-1)
+    if cut < 0:
+        return "", prompt
+    return prompt[:cut].rstrip(), prompt[cut:]
+
+
+def _responses_input(prompt: str) -> list[dict]:
+    """Build Responses API input with the static prompt prefix first (cacheable) and the dynamic tail last."""
+    static_prefix, dynamic_tail = _split_prompt_for_cache(prompt)
+    items: list[dict] = []
+    if static_prefix:
+        items.append({"role": "system", "content": [{"type": "input_text", "text": static_prefix}]})
+    items.append({"role": "user", "content": [{"type": "input_text", "text": dynamic_tail}]})
+    return items
+
+
+def _chat_messages(prompt: str) -> list[dict]:
+    """Chat Completions counterpart of _responses_input."""
+    static_prefix, dynamic_tail = _split_prompt_for_cache(prompt)
+    messages: list[dict] = []
+    if static_prefix:
+        messages.append({"role": "system", "content": static_prefix})
+    messages.append({"role": "user", "content": dynamic_tail})
+    return messages
+
+
+@functools.lru_cache(maxsize=None)
+def _adapter_for(model_cls) -> TypeAdapter:
+    """Return a (cached) TypeAdapter so structured outputs validate straight from bytes."""
+    return TypeAdapter(model_cls)
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_for(model_cls) -> dict:
+    """Return the (cached) JSON schema for a Pydantic model class."""
+    return model_cls.model_json_schema()
+
+
+@functools.lru_cache(maxsize=None)
+def _text_format_for(model_cls) -> dict:
+    """Return the (cached) Responses API `text` parameter requesting strict JSON for model_cls."""
+    return {
+        "format": {
+            "type": "json_schema",
+            "name": model_cls.__name__,
+            "schema": _schema_for(model_cls),
+            "strict": True,
+        }
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_json_for(model_cls) -> str:
+    """Return the (cached) schema serialized for the Chat Completions fallback prompt."""
+    return json.dumps(_schema_for(model_cls), ensure_ascii=False)
+
+
+# Warm the caches for the schemas used every turn so the first request doesn't pay for them
+# (pydantic-core compiles the validator once per TypeAdapter).
+for _model_cls in (RoleDecision, SafetyDecision, CharacterExtraction):
+    _adapter_for(_model_cls)
+    _text_format_for(_model_cls)
+    _schema_json_for(_model_cls)
+del _model_cls
+
+
+# Identical structured prompts (e.g. re-routing the same turn) within 10 minutes reuse the
+# previous parse instead of another model round-trip. Set DISABLE_STRUCT_CACHE=1 to turn off.
+_STRUCT_CACHE: TTLCache = TTLCache(maxsize=512, ttl=600)
+_STRUCT_CACHE_LOCK = threading.Lock()
+# Safety verdicts are always classified fresh, never served from either cache.
+_STRUCT_UNCACHED_MODELS = (SafetyDecision,)
+
+
+def _openai_cache_scope() -> str:
+    """Digest of the OpenAI endpoint and credentials, so cached verdicts never cross configurations."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in (os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"), os.getenv("OPENAI_API_KEY") or ""):
+        data = part.encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _struct_disk_cache_path(model: str, prompt: str, schema_model) -> str | None:
+    """Content-addressed file for a structured call, or None when STRUCT_CACHE_DIR is unset.
+
+    Key = sha256 over length-prefixed (provider, endpoint scope, model, prompt, schema name) so
+    field boundaries can't collide.
+    """
+    root = (os.getenv("STRUCT_CACHE_DIR") or "").strip()
+    if not root:
+        return None
+    h = hashlib.sha256()
+    for part in ("openai", _openai_cache_scope(), model, prompt, schema_model.__name__):
+        data = str(part).encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    digest = h.hexdigest()
+    return os.path.join(root, digest[:2], f"{digest}.json")
+
+
+def _struct_disk_cache_get(path: str | None, schema_model):
+    """Load a cached parse from path (see _struct_disk_cache_path for the key), or None.
+
+    Entries never expire; clear STRUCT_CACHE_DIR to drop them. A missing file is a plain miss, and
+    an unreadable or corrupt file (e.g. failing schema validation) is logged and treated as a miss,
+    so the next successful call overwrites it.
+    """
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            return _adapter_for(schema_model).validate_json(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        debug_openai_error(f"{schema_model.__name__} disk_cache_read", exc)
+        return None
+
+
+def _struct_disk_cache_put(path: str | None, result) -> None:
+    """Write result's JSON to path atomically (temp file + os.replace); write errors are only logged."""
+    if path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(result.model_dump_json().encode("utf-8"))
+        os.replace(tmp, path)
+    except Exception as exc:
+        debug_openai_error(f"{type(result).__name__} disk_cache_write", exc)
+
+
+# Decision models with only scalar fields: a shallow copy already isolates cache entries.
+_SCALAR_DECISION_MODELS = (RoleDecision, SafetyDecision)
+
+
+def _copy_cached_decision(result):
+    """Return a model_copy of a cached parse so a caller mutating its result can't alter the cache entry."""
+    return result.model_copy(deep=not isinstance(result, _SCALAR_DECISION_MODELS))
+
+
 def _call_openai_structured(model: str, prompt: str, schema_model):
-    """Call OpenAI Responses API and parse into Pydantic model."""
+    """Return the structured parse for prompt, from the caches when possible (cache hits are not traced)."""
+    if schema_model in _STRUCT_UNCACHED_MODELS:
+        return _request_openai_structured(model, prompt, schema_model, None, None)
+    cache_key = None
+    if os.getenv("DISABLE_STRUCT_CACHE") != "1":
+        digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+        cache_key = (_openai_cache_scope(), model, schema_model.__name__, digest)
+        with _STRUCT_CACHE_LOCK:
+            cached = _STRUCT_CACHE.get(cache_key)
+        if cached is not None:
+            return _copy_cached_decision(cached)
+
+    # Opt-in persistent cache (STRUCT_CACHE_DIR) for retries and dev loops across processes.
+    disk_path = _struct_disk_cache_path(model, prompt, schema_model)
+    cached = _struct_disk_cache_get(disk_path, schema_model)
+    if cached is not None:
+        if cache_key is not None:
+            with _STRUCT_CACHE_LOCK:
+                _STRUCT_CACHE[cache_key] = _copy_cached_decision(cached)
+        return cached
+    return _request_openai_structured(model, prompt, schema_model, cache_key, disk_path)
+
+
+@traceable(run_type="llm")
+def _request_openai_structured(model: str, prompt: str, schema_model, cache_key, disk_path: str | None):
+    """Call OpenAI Responses API and parse into Pydantic model; successful parses fill the caches."""
     client: OpenAI | None = None
-    text = ""
+    payload = b""
     first_exc: Exception | None = None
     try:
         client = get_openai_client()
@@ -1208,19 +1623,12 @@ def _call_openai_structured(model: str, prompt: str, schema_model):
             raise first_exc or ValueError("OpenAI client is unavailable.")
         response = client.responses.create(
             model=model,
-            input=[{"role": "user", "content": [{"type": "input_text", "text": prompt}]}],
-            text={
-                "format": {
-                    "type": "json_schema",
-                    "name": schema_model.__name__,
-                    "schema": schema_model.model_json_schema(),
-                    "strict": True,
-                }
-            },
+            input=_responses_input(prompt),
+            text=_text_format_for(schema_model),
             stream=True,
         )
         debug_openai_response(f"{schema_model.__name__}", response)
-        text = _collect_stream_text(response)
+        payload = _collect_stream_bytes(response)
     except Exception as exc:
         first_exc = exc
         debug_openai_error(f"{schema_model.__name__} responses", exc)
@@ -1230,25 +1638,26 @@ def _call_openai_structured(model: str, prompt: str, schema_model):
             forced = (
                 prompt.strip()
                 + "\n\nIMPORTANT: Return ONLY a single JSON object matching this schema:\n"
-                + json.dumps(schema_model.model_json_schema(), ensure_ascii=False)
+                + _schema_json_for(schema_model)
             )
             chat = client.chat.completions.create(
                 model=model,
-                messages=[{"role": "user", "content": forced}],
+                messages=_chat_messages(forced),
                 temperature=0,
             )
             msg = chat.choices[0].message
-            text = str(getattr(msg, "content", "") or "")
+            payload = str(getattr(msg, "content", "") or "").encode("utf-8")
         except Exception as exc2:
             debug_openai_error(f"{schema_model.__name__} chat_fallback", exc2)
-            text = ""
+            payload = b""
     try:
-        return schema_model.model_validate_json(text)
+        result = _adapter_for(schema_model).validate_json(payload)
     except Exception as exc:
+        text = payload.decode("utf-8", errors="replace")
         # Fallback: if provider ignores JSON format, try to construct minimal valid payload
         if schema_model.__name__ == "RoleDecision":
             raw = (text or "").strip()
-            mapping = role_map()
+            mapping = _ROLE_MAP
             chosen_id = None
             raw_lower = raw.lower()
             for rid, role in mapping.items():
@@ -1259,80 +1668,587 @@ def _call_openai_structured(model: str, prompt: str, schema_model):
             profile = mapping.get(resolved_id, mapping[DEFAULT_ROLE_ID])
             reason = f"Fallback parse from model output: {raw[:120] or '无理由'}"
             if first_exc is not None and not raw:
-                reason = f"Fallback due to OpenAI error: {_format_openai_error(first_exc).get('message', '')}"
-            return schema_model(
+                reason = f"Fallback due to OpenAI error: {first_exc}"
+            # Trusted values built locally: model_construct skips re-validating them.
+            return schema_model.model_construct(
                 role_id=resolved_id,
                 role_name=profile["name"],
                 reason=reason,
             )
         raise ValueError(f"Failed to parse model output as {schema_model.__name__}: {text}") from exc
+    if cache_key is not None:
+        with _STRUCT_CACHE_LOCK:
+            _STRUCT_CACHE[cache_key] = _copy_cached_decision(result)
+    _struct_disk_cache_put(disk_path, result)
+    return result
+
+
+def _safety_classifier_prompt(user_text: str, planned_prompts: str) -> str:
+    return (
+        "You are a strict-but-practical content safety classifier for a public creative tool.\n"
+        "Task: judge whether the request/planned prompts contain explicit sexual content, explicit nudity, graphic gore, or explicit violence.\n"
+        "Rules:\n"
+        "- sexual=true only for explicit sexual acts/pornographic intent.\n"
+        "- nudity=true if explicit nudity is requested or described for output.\n"
+        "- gore=true only for graphic body harm/viscera/dismemberment close-ups.\n"
+        "- violence=true for explicit harm descriptions that should be softened to PG-13 cinematic implication.\n"
+        "- should_block=true if the assistant must refuse direct generation and ask to rewrite first (typically sexual/porn; or extreme gore).\n"
+        "- should_sanitize=true if output should be rewritten/softened (PG-13) before proceeding.\n"
+        "Return a JSON object matching the provided schema.\n\n"
+        "USER_TEXT:\n"
+        f"{(user_text or '').strip()}\n\n"
+        "PLANNED_PROMPTS (may be empty):\n"
+        f"{(planned_prompts or '').strip()}\n"
+    )
 
 
-def _extract_openai_text(response) -> str:
-    """Best-effort text extraction from OpenAI responses API."""
-    try:
-        if getattr(response, "output_text", None):
-            return response.output_text
-    except Exception:
-        pass
-    try:
-        output = getattr(response, "output", None) or []
-        if output:
-            first = output[0]
-            content = getattr(first, "content", None) or []
-            for block in content:
-                text = getattr(block, "text", None)
-                if text:
-                    return text
-                if hasattr(block, "output_text") and getattr(block, "output_text"):
-                    return getattr(block, "output_text")
-                if isinstance(block, dict):
-                    if block.get("text"):
-                        return block["text"]
-                    if block.get("output_text"):
-                        return block["output_text"]
-    except Exception:
-        pass
-    return ""
+# Sanitizer tables (PG-13 rewrites). Keys never overlap and no replacement contains a key, so a
+# single left-to-right pass gives the same result as applying str.replace per key.
+_SEXUAL_REPLACEMENTS: dict[str, str] = {
+    "无码": "（不展示细节）",
+    "露点": "穿着完整（不露骨）",
+    "裸体": "穿着完整（不露骨）",
+    "性交": "亲密互动（不露骨）",
+    "做爱": "亲密互动（不露骨）",
+    "口交": "亲密互动（不露骨）",
+    "肛交": "亲密互动（不露骨）",
+    "强奸": "性侵（不展示细节，仅点到为止）",
+    "迷奸": "性侵（不展示细节，仅点到为止）",
+    "porn": "（不露骨）",
+}
+_VIOLENT_REPLACEMENTS: dict[str, str] = {
+    "爆头": "强烈冲击（不展示细节）",
+    "脑浆": "冲击性的后果（不展示细节）",
+    "断肢": "受伤倒下（不展示细节）",
+    "肢解": "镜头切走（用暗示表达）",
+    "开膛": "镜头切走（用暗示表达）",
+    "剖腹": "镜头切走（用暗示表达）",
+    "内脏": "不展示细节",
+    "肠子": "不展示细节",
+    "碎尸": "不展示细节",
+    "割喉": "镜头切走（用暗示表达）",
+    "斩首": "镜头切走（用暗示表达）",
+    "砍头": "镜头切走（用暗示表达）",
+    "喷血": "用剪影/反应镜头表达冲击（不展示细节）",
+    "血浆": "用光影/音效表达冲击（不展示细节）",
+    "血肉模糊": "画面用遮挡/虚焦表达（不展示细节）",
+}
 
 
-def _tool_definitions_for_canvas() -> list[dict]:
-    """Expose canvas tools to the LLM for function calling (frontends will execute).
+# Negative-prompt additions appended to createNode configs when the classifier asks to sanitize.
+_SEXUAL_NEGATIVE_PROMPT = "nude, naked, explicit sex, porn, nipples, genitalia"
+_GORE_NEGATIVE_PROMPT = (
+    "gore, dismemberment, intestines, brains, blood splatter close-up, explicit violence, torture porn, nude, explicit sex"
+)
 
-    NOTE: Responses API expects function tools in the flat shape:
-    {type: 'function', name, description?, parameters, strict?}
-    """
-    config_schema = {
-        "type": "object",
-        "description": "节点 data 配置（会写入 node.data）。常用字段：kind、prompt、negativePrompt、systemPrompt、keywords、imageModel/videoModel 等。",
-        "properties": {
-            "kind": {
-                "type": "string",
-                "description": "任务类型（通常由 type 推导），例如 image/textToImage/composeVideo/video。",
-            },
-            "prompt": {"type": "string", "description": "主提示词"},
-            "negativePrompt": {"type": "string", "description": "负面提示词"},
-            "systemPrompt": {"type": "string", "description": "系统提示词/风格基准"},
-            "keywords": {
-                "type": ["string", "array"],
-                "items": {"type": "string"},
-                "description": "关键词（可用逗号分隔字符串或数组）",
-            },
-            "imageModel": {"type": "string", "description": "图像模型（可选）"},
-            "videoModel": {"type": "string", "description": "视频模型（可选）"},
-        },
-        "additionalProperties": True,
+# Substring gates on the last user message (finalize_answer).
+_STORY_SUGGEST_CONTINUE_KEYWORDS = ("续写", "后续剧情", "接下来", "续作")
+_STORY_SUGGEST_ASK_KEYWORDS = ("推荐", "方向", "灵感", "怎么写")
+_STORY_SUGGEST_EXCLUDE_KEYWORDS = ("九宫格", "分镜", "故事板", "storyboard", "15s")
+_STORYBOARD_REQUEST_KEYWORDS = ("九宫格", "分镜图", "故事板", "storyboard")
+_GENERATE_VERB_KEYWORDS = ("生成", "出", "做成")
+_GENERATE_OUTPUT_KEYWORDS = ("分镜", "九宫格", "故事板", "图片", "生图", "视频", "15s", "15秒")
+_LOCK_EXPLICIT_KEYWORDS = ("确认锁定", "锁定场景", "锁定主体", "锁定风格", "确认风格", "风格锁定", "我确认", "确认：")
+_LOCK_IMPLICIT_KEYWORDS = ("继续", "按你给的", "就按这个", "照这个来", "不用确认", "直接生成", "别问了")
+_STYLE_LOCK_PREFIXES = ("确认锁定风格：", "风格锁定：", "锁定风格：")
+_CONTINUATION_STEP_KEYWORDS = ("我选择方向", "自定义续写", "续写")
+_CANVAS_OPT_OUT_KEYWORDS = ("先不操作画布", "不要操作画布", "只聊", "只写", "不要生成", "不生成")
+_REFERENCE_INTENT_KEYWORDS = ("基于", "同款", "同风格", "沿用", "续写", "延展", "变体", "参考", "保持一致")
+
+
+def _keyword_re(keywords: Sequence[str]) -> re.Pattern:
+    """Compile keywords into one alternation; `.search(text)` is `any(k in text for k in keywords)`."""
+    return re.compile("|".join(map(re.escape, keywords)))
+
+
+def _compile_keyword_gates(groups: dict[int, tuple[str, ...]]):
+    """Return a text -> bitmask function: the OR of every group bit whose keywords occur in text."""
+    gates = tuple((bit, _keyword_re(keywords).search) for bit, keywords in groups.items())
+
+    def flags(text: str) -> int:
+        bits = 0
+        for bit, search in gates:
+            if search(text):
+                bits |= bit
+        return bits
+
+    return flags
+
+
+_GATE_SUGGEST_CONTINUE = 1 << 0
+_GATE_SUGGEST_ASK = 1 << 1
+_GATE_STORYBOARD_WORDS = 1 << 2
+_GATE_STORYBOARD_REQUEST = 1 << 3
+_GATE_GENERATE_VERB = 1 << 4
+_GATE_GENERATE_OUTPUT = 1 << 5
+_GATE_LOCK_EXPLICIT = 1 << 6
+_GATE_LOCK_IMPLICIT = 1 << 7
+_GATE_CONTINUATION_STEP = 1 << 8
+_GATE_CANVAS_OPT_OUT = 1 << 9
+_GATE_REFERENCE_INTENT = 1 << 10
+
+# One precompiled search per gate over the last user message.
+_user_gate_flags = _compile_keyword_gates(
+    {
+        _GATE_SUGGEST_CONTINUE: _STORY_SUGGEST_CONTINUE_KEYWORDS,
+        _GATE_SUGGEST_ASK: _STORY_SUGGEST_ASK_KEYWORDS,
+        _GATE_STORYBOARD_WORDS: _STORY_SUGGEST_EXCLUDE_KEYWORDS,
+        _GATE_STORYBOARD_REQUEST: _STORYBOARD_REQUEST_KEYWORDS,
+        _GATE_GENERATE_VERB: _GENERATE_VERB_KEYWORDS,
+        _GATE_GENERATE_OUTPUT: _GENERATE_OUTPUT_KEYWORDS,
+        _GATE_LOCK_EXPLICIT: _LOCK_EXPLICIT_KEYWORDS,
+        _GATE_LOCK_IMPLICIT: _LOCK_IMPLICIT_KEYWORDS,
+        _GATE_CONTINUATION_STEP: _CONTINUATION_STEP_KEYWORDS,
+        _GATE_CANVAS_OPT_OUT: _CANVAS_OPT_OUT_KEYWORDS,
+        _GATE_REFERENCE_INTENT: _REFERENCE_INTENT_KEYWORDS,
     }
-    return [
-        {
-            "type": "function",
-            "name": "createNode",
-            "description": "创建画布节点（仅支持 image/textToImage/composeVideo/video）。config 会写入 node.data。",
-            "strict": False,
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "type": {
+)
+
+_STYLE_LOCK_PREFIX_RE = re.compile("|".join(map(re.escape, _STYLE_LOCK_PREFIXES)))
+
+
+def _extract_style_lock_from_messages(messages_obj: list | None) -> str | None:
+    """Return the newest style lock the user confirmed (text after a lock prefix), if any."""
+    if not isinstance(messages_obj, list):
+        return None
+    for i in range(len(messages_obj) - 1, -1, -1):
+        m = messages_obj[i]
+        # Prefer user confirmations
+        if not _is_user_message(m):
+            continue
+        text = str(getattr(m, "content", "") or "")
+        # One scan rejects the common no-lock message before trying the prefixes in priority order.
+        if not text or not _STYLE_LOCK_PREFIX_RE.search(text):
+            continue
+        for key in _STYLE_LOCK_PREFIXES:
+            if key in text:
+                after = text.split(key, 1)[1].strip()
+                if not after:
+                    continue
+                first_line = after.splitlines()[0].strip()
+                return first_line[:80] if first_line else None
+    return None
+
+
+# Storyboard detection on createNode label+prompt hints and on node labels.
+_STORYBOARD_HINT_KEYWORDS = ("九宫格", "3x3", "分镜", "storyboard")
+_STORYBOARD_LABEL_KEYWORDS = ("分镜", "九宫格", "storyboard")
+
+
+_STORYBOARD_HINT_RE = _keyword_re(_STORYBOARD_HINT_KEYWORDS)
+_STORYBOARD_LABEL_RE = _keyword_re(_STORYBOARD_LABEL_KEYWORDS)
+# Reference-image scoring on canvas node labels (case-sensitive, like the original substring checks).
+_STORYBOARD_OR_VIDEO_LABEL_RE = _keyword_re(("分镜", "九宫格", "storyboard", "视频", "15s视频"))
+_CHARACTER_LABEL_RE = _keyword_re(("角色", "设定", "立绘", "主视觉", "character", "design"))
+_PROP_LABEL_RE = _keyword_re(("产品", "道具", "物件", "prop", "product"))
+# Matched against label.lower(); lower() leaves the CJK keywords unchanged.
+_ANIMAL_LABEL_RE = _keyword_re(("fox", "bunny", "rabbit", "狐狸", "兔子"))
+
+
+# Appended to a composeVideo prompt whose requested duration was clamped to 15s.
+_VIDEO_PART_ONE_HINT = "\n\n约束：本次为第1段（<=15秒）。如需更长成片，请分段生成第2段/第3段。"
+
+
+def _clamp_compose_video_duration(cfg: dict) -> None:
+    """Enforce the single-run duration constraint on a composeVideo config, in place.
+
+    Default models run 10–15 seconds; MiniMax runs 6s or 10s. A longer request is clamped (the UX
+    creates additional segments) and gets a part-one hint in its prompt.
+    """
+    model_lower = str(cfg.get("videoModel") or cfg.get("model") or cfg.get("modelKey") or "").lower()
+    vendor_lower = str(cfg.get("videoModelVendor") or cfg.get("vendor") or "").lower()
+    is_minimax = ("minimax" in vendor_lower) or any(
+        kw in model_lower for kw in ("minimax", "hailuo", "i2v")
+    )
+
+    raw_dur = cfg.get("videoDurationSeconds")
+    if raw_dur is None:
+        raw_dur = cfg.get("durationSeconds")
+    if raw_dur is None:
+        raw_dur = cfg.get("duration")
+    # NaN compares false to every bound, so it is left untouched (as before).
+    if not isinstance(raw_dur, (int, float)) or not (is_minimax or raw_dur == raw_dur):
+        return
+    if is_minimax:
+        # MiniMax video only supports 6s / 10s.
+        normalized = 10 if raw_dur >= 8 else 6
+    else:
+        normalized = 10 if raw_dur < 10 else 15 if raw_dur > 15 else int(round(raw_dur))
+    cfg["videoDurationSeconds"] = cfg["durationSeconds"] = normalized
+    # Add a gentle hint so the user can continue with Part 2, without forcing extra nodes.
+    if not is_minimax and raw_dur > 15:
+        prompt_val = cfg.get("prompt")
+        if isinstance(prompt_val, str) and "分段" not in prompt_val:
+            cfg["prompt"] = prompt_val.rstrip() + _VIDEO_PART_ONE_HINT
+
+
+# Appended to the storyboard grid prompt so panels chain into each other (and into the previous grid).
+_STORYBOARD_CONTINUITY_SUFFIX = (
+    "\n\n连续性要求（很重要）：\n"
+    "- 九宫格面板之间要有“衔接帧”感觉：面板N的结尾姿态/构图/机位/光线，应与面板N+1的开场保持一致（像同一动作的承接），避免突兀跳切。\n"
+    "- 如果上游参考里包含上一张九宫格分镜图：请让本次面板1自然承接上一张的面板9（构图/主体位置/光线延续），再继续推进新内容。\n"
+    "- 场景不要自由切换；主体数量不要在分镜中途增删。\n"
+)
+# Prompt of the composeVideo node auto-created downstream of a storyboard grid; the grid's own
+# prompt is appended after the header when available.
+_STORYBOARD_VIDEO_PROMPT = (
+    "根据上游参考图片（九宫格分镜图）生成一个15秒的二维动画视频：\n"
+    "- 画面风格/角色外观严格跟随参考图；不要改变角色造型与配色。\n"
+    "- 按参考图的镜头节奏推进（从1到9），镜头之间自然衔接；保持同一场景光线连续。\n"
+    "- 不要出现任何可读文字/水印/Logo。\n"
+    "- 输出16:9，动作清晰，镜头稳定，节奏温暖治愈。"
+)
+# "九宫格分镜" / "分镜" in a storyboard label become "15s视频" in the derived video label.
+_STORYBOARD_LABEL_WORD_RE = re.compile("九宫格分镜|分镜")
+_STORYBOARD_VIDEO_HINT_HEADER = "\n\n分镜补充（来自九宫格分镜的镜头描述，用于动作/镜头节奏对齐；以参考图为准）：\n"
+
+# Quick-reply button sets offered by finalize_answer, as (label, input) pairs.
+_QR_SEXUAL_BLOCKED: tuple[tuple[str, str], ...] = (
+    (
+        "改成含蓄浪漫（不露骨）",
+        "把刚才的内容改写成含蓄浪漫、PG-13表达：不出现裸体/性行为/露骨描写，用暗示与情绪推进；然后再生成九宫格分镜。",
+    ),
+    (
+        "改成亲密但克制",
+        "把亲密内容改成拥抱/牵手/靠近等克制表达（不涉及色情），强调关系与情绪；然后再生成分镜/视频。",
+    ),
+    (
+        "只保留剧情，不生成画面",
+        "先不要生成画面。把内容改成适合大众平台的剧情梗概（不露骨），并给我3个可选走向按钮。",
+    ),
+    (
+        "我只是要分镜（无色情）",
+        "我这段没有色情/裸露/性行为内容，只是要做分镜与提示词；请按原剧情继续生成九宫格分镜与统一提示词，并在提示词里明确：无裸露、无性行为、PG-13。",
+    ),
+)
+_QR_STORY_DIRECTIONS: tuple[tuple[str, str], ...] = (
+    (
+        "方向A：暖心日常",
+        "我选择方向A（暖心日常）：请基于当前项目已有剧情与角色关系（沿用同一世界观/场景/氛围）续写下一段 15 秒的小故事。先给我紧凑剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
+    ),
+    (
+        "方向B：轻冒险任务",
+        "我选择方向B（轻冒险任务）：请基于当前项目已有剧情续写，加入一个小目标/小危机但保持治愈基调。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
+    ),
+    (
+        "方向C：小悬疑反转",
+        "我选择方向C（小悬疑反转）：请基于当前项目已有剧情续写，前半段制造小谜团，结尾温暖反转（不要跳出既有设定）。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
+    ),
+    (
+        "自定义方向…",
+        "我想自定义续写方向（基于当前项目已有剧情，不要另起炉灶）：\n- 主题/情绪：\n- 场景：\n- 关键事件：\n- 结尾落点：\n请基于我的填写先给梗概，再做九宫格分镜与15s视频。",
+    ),
+)
+_QR_LOCK_DEFAULT: tuple[tuple[str, str], ...] = (
+    (
+        "继续（锁定+先做角色设定图）",
+        "确认锁定风格：日漫2D（干净线稿+赛璐璐）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。\n第一步：先为所有主要角色生成可复现的角色设定图/参考图（character/image 节点），并把这些参考图连到后续分镜节点作为引用。\n第二步：再生成 3x3 九宫格分镜图。",
+    ),
+    (
+        "锁定风格：美漫2D（粗线条）",
+        "确认锁定风格：美漫2D（粗线条+高对比）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。\n第一步：先为所有主要角色生成可复现的角色设定图/参考图（character/image 节点），并把这些参考图连到后续分镜节点作为引用。\n第二步：再生成 3x3 九宫格分镜图。",
+    ),
+    (
+        "锁定风格：写实真人",
+        "确认锁定风格：写实真人（电影质感）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。\n第一步：先为所有主要角色生成可复现的角色设定图/参考图（character/image 节点），并把这些参考图连到后续分镜节点作为引用。\n第二步：再生成 3x3 九宫格分镜图。",
+    ),
+    (
+        "自定义风格…",
+        "确认锁定风格：\n- 风格类型（2D日漫/2D美漫/写实/其他）：\n- 线条/材质：\n- 色彩与光影：\n- 镜头语言：\n同时：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。填写后请生成 3x3 九宫格分镜图并连线参考图。",
+    ),
+)
+_QR_LOCK_STYLE_KNOWN: tuple[tuple[str, str], ...] = (
+    (
+        "继续（按已锁定风格生成分镜）",
+        "确认锁定风格：{style_lock}。确认锁定：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（主角数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
+    ),
+    (
+        "新增主体…（先出设定图）",
+        "我要新增主体（角色/产品/关键道具）：\n- 主体1：\n- 主体2：\n要求：先分别生成每个主体的设定图（image），等我确认后再生成九宫格分镜并连线消费这些设定图。",
+    ),
+    (
+        "改场景…（先锁定场景图）",
+        "我想锁定新的主场景：\n- 场景描述：\n要求：先生成一张“场景设定图”（image）给我确认；确认后九宫格分镜必须只在该场景内推进（光线连续），再生成15s视频。",
+    ),
+    (
+        "自定义锁定规则…",
+        "我想自定义锁定规则：\n- 主场景（只能一个）：\n- 允许的过渡场景（可选）：\n- 主体清单（角色/产品/道具）与数量：\n- 禁止事项：\n请按我的规则先补齐必要的设定图，再生成九宫格分镜并继续。",
+    ),
+)
+_QR_CANVAS_TOOLS_OFF: tuple[tuple[str, str], ...] = (
+    (
+        "继续创作（先选方向）",
+        "基于我当前项目画布，先给 3 个可选方向（按钮）让我选；我选完你再在画布创建分镜/视频节点。",
+    ),
+    (
+        "直接生成（我给具体需求）",
+        "我想在画布生成一个内容：\n- 类型（图片/分镜/视频）：\n- 主题：\n- 风格：\n- 时长/比例（如需要）：\n请按我的填写创建节点并执行。",
+    ),
+    (
+        "只聊不操作画布",
+        "先不操作画布。请先用一句话问我：我想做什么类型的内容、有什么参考、以及希望的风格/时长。",
+    ),
+)
+_QR_NEW_CHARACTER_CONFIRM: tuple[tuple[str, str], ...] = (
+    (
+        "角色OK，继续分镜",
+        "新角色我确认OK。请把新角色纳入同一项目设定，基于已有剧情续写下一段，并生成九宫格分镜（image）再连接到15s视频（composeVideo）。",
+    ),
+    (
+        "重做这个角色",
+        "这个新角色不满意。请保持同一角色定位与风格，重做 3 个版本给我选（同一个 image 节点出 3 张即可）。",
+    ),
+    (
+        "不要新角色",
+        "不要新增角色了。请只用现有角色基于已有剧情续写，并生成九宫格分镜与15s视频。",
+    ),
+)
+
+
+def _quick_replies(pairs: tuple[tuple[str, str], ...], **fmt: str) -> list[dict]:
+    """Materialize (label, input) pairs as fresh quick-reply dicts; `fmt` fills {placeholders} in inputs."""
+    if fmt:
+        return [{"label": label, "input": text.format(**fmt)} for label, text in pairs]
+    return [{"label": label, "input": text} for label, text in pairs]
+
+
+def _canvas_labels_from_context(canvas_context_obj: dict | None) -> set[str]:
+    """Stripped, non-empty labels of the nodes in canvas_context."""
+    if not isinstance(canvas_context_obj, dict):
+        return set()
+    nodes_ctx = canvas_context_obj.get("nodes")
+    if not isinstance(nodes_ctx, list):
+        return set()
+    labels: set[str] = set()
+    for n in nodes_ctx:
+        if not isinstance(n, dict):
+            continue
+        label = n.get("label")
+        if isinstance(label, str) and label.strip():
+            labels.add(label.strip())
+    return labels
+
+
+class _NormCall:
+    """Fields of one tool call extracted once; `call`, `args` and `cfg` are the live dicts."""
+
+    __slots__ = ("call", "name", "args", "type", "label", "cfg", "_storyboard")
+
+    def __init__(self, call: dict) -> None:
+        self.call = call
+        self.name = call.get("name")
+        args = call.get("arguments")
+        self.args: dict = args if isinstance(args, dict) else {}
+        self.type = self.args.get("type")
+        label = self.args.get("label")
+        self.label: str = label.strip() if isinstance(label, str) else ""
+        cfg = self.args.get("config")
+        self.cfg: dict | None = cfg if isinstance(cfg, dict) else None
+        self._storyboard: bool | None = None
+
+    def storyboard_hint(self) -> bool:
+        """Whether label or config prompt mentions a storyboard grid; computed on first use."""
+        if self._storyboard is None:
+            prompt = self.cfg.get("prompt") if self.cfg is not None else None
+            hint = f"{self.label}\n{prompt if isinstance(prompt, str) else ''}"
+            self._storyboard = _STORYBOARD_HINT_RE.search(hint) is not None
+        return self._storyboard
+
+
+def _norm_calls(tool_calls: list | None) -> list[_NormCall]:
+    return [_NormCall(c) for c in tool_calls or () if isinstance(c, dict)]
+
+
+class _ToolCallIndex:
+    """Positions and label sets of a tool-call payload, collected in one pass.
+
+    Indices refer to the payload as it was when indexed; rebuild after inserting calls.
+    """
+
+    __slots__ = ("connect_pairs", "create_at", "runs_at", "image_labels", "video_labels")
+
+    def __init__(self, tool_calls: list) -> None:
+        self.connect_pairs: set[tuple[str, str]] = set()
+        self.create_at: dict[str, list[int]] = {}
+        self.runs_at: dict[str, list[int]] = {}
+        self.image_labels: list[str] = []
+        self.video_labels: list[str] = []
+        for i, c in enumerate(tool_calls):
+            if not isinstance(c, dict):
+                continue
+            name = c.get("name")
+            args = c.get("arguments")
+            if not isinstance(args, dict):
+                continue
+            if name == "connectNodes":
+                src = args.get("sourceNodeId") or args.get("sourceId")
+                tgt = args.get("targetNodeId") or args.get("targetId")
+                if isinstance(src, str) and isinstance(tgt, str):
+                    s = src.strip()
+                    t = tgt.strip()
+                    if s and t:
+                        self.connect_pairs.add((s, t))
+            elif name == "createNode":
+                label = args.get("label")
+                if not isinstance(label, str) or not label.strip():
+                    continue
+                label = label.strip()
+                self.create_at.setdefault(label, []).append(i)
+                node_type = args.get("type")
+                if node_type in ("image", "textToImage"):
+                    self.image_labels.append(label)
+                elif node_type == "composeVideo":
+                    self.video_labels.append(label)
+            elif name == "runNode":
+                node_id = args.get("nodeId")
+                if isinstance(node_id, str) and node_id.strip():
+                    self.runs_at.setdefault(node_id.strip(), []).append(i)
+
+    def first_run(self, label: str) -> int | None:
+        """Index of the first runNode(label) call, or None when label is never run."""
+        runs = self.runs_at.get(label)
+        return runs[0] if runs else None
+
+    def create_before_run(self, label: str) -> int | None:
+        """Index of the last createNode(label) ahead of its first runNode (or anywhere if never run)."""
+        run_idx = self.first_run(label)
+        positions = [i for i in self.create_at.get(label, ()) if run_idx is None or i < run_idx]
+        return positions[-1] if positions else None
+
+
+def _run_target(call: dict) -> str:
+    """Stripped nodeId of a runNode call ("" for other calls or a missing id)."""
+    if call.get("name") != "runNode":
+        return ""
+    args = call.get("arguments")
+    node_id = args.get("nodeId") if isinstance(args, dict) else None
+    return node_id.strip() if isinstance(node_id, str) else ""
+
+
+def _compile_replacer(table: dict[str, str]):
+    """Return a one-pass multi-keyword replacer for table (longest key wins at a position)."""
+    pattern = re.compile("|".join(map(re.escape, sorted(table, key=len, reverse=True))))
+    lookup = table.__getitem__
+
+    def replace(text: str) -> str:
+        return pattern.sub(lambda m: lookup(m.group(0)), text)
+
+    return replace
+
+
+_replace_sexual = _compile_replacer(_SEXUAL_REPLACEMENTS)
+_replace_violent = _compile_replacer(_VIOLENT_REPLACEMENTS)
+
+
+def _append_negative_prompt(cfg: dict, addition: str) -> None:
+    """Append addition to cfg["negativePrompt"] unless it is already present."""
+    neg = cfg.get("negativePrompt")
+    neg_text = neg if isinstance(neg, str) else ""
+    if addition not in neg_text:
+        cfg["negativePrompt"] = (f"{neg_text}\n{addition}" if neg_text else addition).strip()
+
+
+def _sanitize_sexual_text(text: str) -> str:
+    if not isinstance(text, str) or not text.strip():
+        return text
+    return _replace_sexual(text)
+
+
+def _sanitize_violent_text(text: str) -> str:
+    if not isinstance(text, str) or not text.strip():
+        return text
+    return _replace_violent(text)
+
+
+_EMPTY_SAFETY_DECISION = SafetyDecision.model_construct(
+    sexual=False,
+    nudity=False,
+    gore=False,
+    violence=False,
+    should_block=False,
+    should_sanitize=False,
+    reason="No user text or planned prompts to classify.",
+)
+
+
+def _classify_safety_decision(model: str, user_text: str, planned_prompts: str) -> SafetyDecision:
+    """Classify via the structured call (never cached; see _STRUCT_UNCACHED_MODELS)."""
+    if not (user_text or "").strip() and not (planned_prompts or "").strip():
+        # Nothing to classify (e.g. a tool-only turn with no createNode prompts): skip the round-trip.
+        return _copy_cached_decision(_EMPTY_SAFETY_DECISION)
+    return _call_openai_structured(model, _safety_classifier_prompt(user_text, planned_prompts), SafetyDecision)
+
+
+# Runs the safety classifier alongside the main answer call when its input is already final.
+_SAFETY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="safety-classifier")
+
+
+def _prefetch_safety_decision(model: str, user_text: str) -> concurrent.futures.Future:
+    """Start classifying a turn with no planned prompts; keeps the tracing context of the caller."""
+    ctx = contextvars.copy_context()
+    return _SAFETY_EXECUTOR.submit(ctx.run, _classify_safety_decision, model, user_text, "")
+
+
+def _extract_openai_text(response) -> str:
+    """Best-effort text extraction from OpenAI responses API.
+
+    Prefers `output_text`; otherwise joins the text blocks of every output item in one pass.
+    """
+    text = getattr(response, "output_text", None)
+    if isinstance(text, str) and text:
+        return text
+    parts: list[str] = []
+    for item in getattr(response, "output", None) or ():
+        content = item.get("content") if isinstance(item, dict) else getattr(item, "content", None)
+        for block in content or ():
+            if isinstance(block, dict):
+                t = block.get("text") or block.get("output_text")
+            else:
+                t = getattr(block, "text", None) or getattr(block, "output_text", None)
+            if isinstance(t, str) and t:
+                parts.append(t)
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def _tool_definitions_for_canvas() -> tuple[dict, ...]:
+    """Expose canvas tools to the LLM for function calling (frontends will execute).
+
+    NOTE: Responses API expects function tools in the flat shape:
+    {type: 'function', name, description?, parameters, strict?}
+    The definitions are static and cached; _tool_definitions_for_role hands out copies.
+    """
+    config_schema = {
+        "type": "object",
+        "description": "节点 data 配置（会写入 node.data）。常用字段：kind、prompt、negativePrompt、systemPrompt、keywords、imageModel/videoModel 等。",
+        "properties": {
+            "kind": {
+                "type": "string",
+                "description": "任务类型（通常由 type 推导），例如 image/textToImage/composeVideo/video。",
+            },
+            "prompt": {"type": "string", "description": "主提示词"},
+            "negativePrompt": {"type": "string", "description": "负面提示词"},
+            "systemPrompt": {"type": "string", "description": "系统提示词/风格基准"},
+            "keywords": {
+                "type": ["string", "array"],
+                "items": {"type": "string"},
+                "description": "关键词（可用逗号分隔字符串或数组）",
+            },
+            "imageModel": {"type": "string", "description": "图像模型（可选）"},
+            "videoModel": {"type": "string", "description": "视频模型（可选）"},
+        },
+        "additionalProperties": True,
+    }
+    return (
+        {
+            "type": "function",
+            "name": "createNode",
+            "description": "创建画布节点（仅支持 image/textToImage/composeVideo/video）。config 会写入 node.data。",
+            "strict": False,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "type": {
                         "type": "string",
                         "enum": ["image", "textToImage", "composeVideo", "video"],
                         "description": "逻辑节点类型（前端会映射成 taskNode.kind）",
@@ -1414,61 +2330,116 @@ def _tool_definitions_for_canvas() -> list[dict]:
                 "additionalProperties": False,
             },
         },
-    ]
+    )
 
 
 def _tool_definitions_for_role(role_id: str, allow_canvas_tools: bool) -> list[dict]:
-    """Return tool definitions filtered by role permissions and the decision-layer gate."""
+    """Return tool definitions filtered by role permissions and the decision-layer gate.
+
+    The result is a deep copy of the cached definitions, so callers may modify it freely.
+    """
     if not allow_canvas_tools:
         return []
     resolved_id = normalize_role_id(role_id or DEFAULT_ROLE_ID)
-    allowed = ROLE_ALLOWED_CANVAS_TOOLS.get(resolved_id, set())
+    allowed = ROLE_ALLOWED_CANVAS_TOOLS.get(resolved_id, _NO_TOOLS)
     if not allowed:
         return []
-    return [t for t in _tool_definitions_for_canvas() if t.get("name") in allowed]
+    return copy.deepcopy([t for t in _tool_definitions_for_canvas() if t.get("name") in allowed])
 
 
 def _filter_tool_calls_by_role(tool_calls: list[dict], role_id: str, allow_canvas_tools: bool) -> list[dict]:
     if not allow_canvas_tools:
         return []
     resolved_id = normalize_role_id(role_id or DEFAULT_ROLE_ID)
-    allowed = ROLE_ALLOWED_CANVAS_TOOLS.get(resolved_id, set())
+    allowed = ROLE_ALLOWED_CANVAS_TOOLS.get(resolved_id, _NO_TOOLS)
     if not allowed:
         return []
+    # Identical repeated calls (the model sometimes emits the same createNode twice) would be
+    # executed twice by the canvas, so keep only the first of each (name, arguments).
     filtered: list[dict] = []
-    for c in tool_calls or []:
+    seen: set[tuple] = set()
+    for c in tool_calls or ():
         if not isinstance(c, dict):
             continue
         name = c.get("name")
-        if name in allowed:
-            filtered.append(c)
+        if name not in allowed:
+            continue
+        try:
+            key = (name, orjson.dumps(c.get("arguments"), option=orjson.OPT_SORT_KEYS))
+        except TypeError:
+            key = None
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        filtered.append(c)
     return filtered
 
 
+@functools.lru_cache(maxsize=64)
 def _resolve_role(role_id: str):
-    """Return a validated role id and its profile."""
+    """Return a validated role id and its profile (cached; the profile dict is shared)."""
     resolved_id = normalize_role_id(role_id)
-    mapping = role_map()
-    profile = mapping.get(resolved_id, mapping[DEFAULT_ROLE_ID])
+    profile = _ROLE_MAP.get(resolved_id, _ROLE_MAP[DEFAULT_ROLE_ID])
     return resolved_id, profile
 
 
-def _tail_messages(messages: list, limit: int) -> list:
-    if not isinstance(messages, list) or limit <= 0:
+def _tail_messages(messages: Sequence, limit: int) -> Sequence:
+    """Return the last `limit` messages without copying when the history is already short enough.
+
+    A negative slice only copies `limit` references; islice would walk the whole history from the
+    head, and downstream formatters need len()/indexing, so the result stays a sequence.
+    """
+    if not isinstance(messages, (list, tuple)) or limit <= 0:
         return []
     if len(messages) <= limit:
         return messages
     return messages[-limit:]
 
 
-def _render_compact_conversation(state: OverallState, *, tail: int = 16) -> str:
-    """Render a compact conversation string for prompts.
+# Rendered conversation strings keyed by a digest of (renderer, summary, type + content of each tail
+# message). The graph re-renders the same tail from several nodes and on agent-loop re-entry within
+# a turn; keying on a digest keeps the cache from holding the conversation text itself.
+_CONVERSATION_RENDER_CACHE: LRUCache = LRUCache(maxsize=64)
+_CONVERSATION_RENDER_LOCK = threading.Lock()
 
-    Prefer the durable `conversation_summary` (if present), plus the most recent turns.
-    This keeps role selection stable without exploding prompt length on long chats.
-    """
+
+def _conversation_render_key(kind: str, summary, tail_messages: Sequence) -> bytes | None:
+    """Content-based cache key; None (don't cache) when any message has non-text content."""
+    h = hashlib.blake2b(digest_size=16)
+    parts = [kind, summary if isinstance(summary, str) else ""]
+    for m in tail_messages:
+        content = getattr(m, "content", None)
+        if not isinstance(content, str):
+            return None
+        parts.append(type(m).__qualname__)
+        parts.append(content)
+    # Length-prefix each field so boundaries can't collide (and a missing summary differs from "").
+    h.update(b"\x01" if isinstance(summary, str) else b"\x00")
+    for part in parts:
+        data = part.encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.digest()
+
+
+def _cached_conversation_render(kind: str, state: OverallState, tail: int, render) -> str:
     summary = state.get("conversation_summary")
     tail_messages = _tail_messages(state.get("messages") or [], tail)
+    key = _conversation_render_key(kind, summary, tail_messages)
+    if key is not None:
+        with _CONVERSATION_RENDER_LOCK:
+            cached = _CONVERSATION_RENDER_CACHE.get(key)
+        if cached is not None:
+            return cached
+    rendered = render(summary, tail_messages)
+    if key is not None:
+        with _CONVERSATION_RENDER_LOCK:
+            _CONVERSATION_RENDER_CACHE[key] = rendered
+    return rendered
+
+
+def _render_compact_conversation_uncached(summary, tail_messages: Sequence) -> str:
     recent = format_messages_for_prompt(tail_messages)
     if isinstance(summary, str) and summary.strip():
         if recent.strip():
@@ -1477,9 +2448,17 @@ def _render_compact_conversation(state: OverallState, *, tail: int = 16) -> str:
     return recent
 
 
-def _get_research_topic_with_summary(state: OverallState, *, tail: int = 16) -> str:
-    summary = state.get("conversation_summary")
-    topic = get_research_topic(_tail_messages(state.get("messages") or [], tail))
+def _render_compact_conversation(state: OverallState, *, tail: int = 16) -> str:
+    """Render a compact conversation string for prompts.
+
+    Prefer the durable `conversation_summary` (if present), plus the most recent turns.
+    This keeps role selection stable without exploding prompt length on long chats.
+    """
+    return _cached_conversation_render("compact", state, tail, _render_compact_conversation_uncached)
+
+
+def _research_topic_with_summary_uncached(summary, tail_messages: Sequence) -> str:
+    topic = get_research_topic(tail_messages)
     if isinstance(summary, str) and summary.strip():
         s = summary.strip()
         if isinstance(topic, str) and topic.strip():
@@ -1488,6 +2467,47 @@ def _get_research_topic_with_summary(state: OverallState, *, tail: int = 16) ->
     return topic
 
 
+def _get_research_topic_with_summary(state: OverallState, *, tail: int = 16) -> str:
+    return _cached_conversation_render("topic", state, tail, _research_topic_with_summary_uncached)
+
+
+# select_role short-turn heuristics: one precompiled alternation per keyword list.
+_EXPLICIT_EXECUTE_HINTS = (
+    "不用确认",
+    "不必确认",
+    "别问",
+    "直接执行",
+    "直接生成",
+    "自动执行",
+    "自执行",
+    "run",
+    "tool",
+)
+_CREATION_HINTS = (
+    "生成",
+    "创建",
+    "画",
+    "做",
+    "帮",
+    "续写",
+    "分镜",
+    "故事板",
+    "九宫格",
+    "视频",
+    "图片",
+    "改",
+    "调整",
+    "修改",
+    "连接",
+    "运行",
+)
+_EXPLICIT_EXECUTE_HINTS_RE = re.compile("|".join(map(re.escape, _EXPLICIT_EXECUTE_HINTS)))
+_CREATION_HINTS_RE = re.compile("|".join(map(re.escape, _CREATION_HINTS)))
+
+# Fenced quick-reply block: ```tapcanvas_actions[ info]\n{...}```
+_TAPCANVAS_RE = re.compile(r"```tapcanvas_actions[^\n]*\n(.*?)```", re.DOTALL)
+
+
 # Nodes
 @traceable
 def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
@@ -1501,11 +2521,9 @@ def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
     if interaction_mode not in ("agent", "agent_max", "plan"):
         interaction_mode = "agent"
     conversation = _render_compact_conversation(state, tail=16)
-    canvas_context = state.get("canvas_context")
-    canvas_context_text = _render_canvas_context_for_prompt(canvas_context)
-    prompt = role_router_instructions.format(
-        roles_block=roles_prompt_block(),
-        default_role_id=DEFAULT_ROLE_ID,
+    # Rendered once per turn; finalize_answer and summarize_memory read it back from state.
+    canvas_context_text = _render_canvas_context_for_prompt(state.get("canvas_context"))
+    prompt = _ROLE_ROUTER_PROMPT(
         conversation=conversation,
         canvas_context=canvas_context_text,
     )
@@ -1518,12 +2536,7 @@ def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
         )
     else:
         require_gemini_key()
-        llm = ChatGoogleGenerativeAI(
-            model=configurable.role_selector_model,
-            temperature=0,
-            max_retries=2,
-            api_key=get_gemini_api_key(),
-        )
+        llm = _gemini_chat(configurable.role_selector_model)
         result = llm.with_structured_output(RoleDecision).invoke(prompt)
 
     resolved_id, profile = _resolve_role(result.role_id)
@@ -1561,62 +2574,26 @@ def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
     # Safety fallback (heuristic, not strict string matching):
     # For very short, low-information user turns that do not contain any creation intent,
     # default to not executing canvas tools in this turn.
-    try:
-        last_user_text = ""
-        for m in reversed(state.get("messages") or []):
-            if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-                last_user_text = str(getattr(m, "content", "") or "")
-                break
-        t = (last_user_text or "").strip()
-        # Collapse whitespace
-        t_compact = " ".join(t.split())
-
-        if interaction_mode == "plan" and allow_canvas_tools:
-            explicit_execute_hints = (
-                "不用确认",
-                "不必确认",
-                "别问",
-                "直接执行",
-                "直接生成",
-                "自动执行",
-                "自执行",
-                "run",
-                "tool",
-            )
-            if not any(k in t_compact for k in explicit_execute_hints):
-                allow_canvas_tools = False
-                allow_canvas_tools_reason = "Plan 模式：按步骤询问确认，本轮不自动执行画布工具。"
-                tool_tier = "none"
-
-        creation_hints = (
-            "生成",
-            "创建",
-            "画",
-            "做",
-            "帮",
-            "续写",
-            "分镜",
-            "故事板",
-            "九宫格",
-            "视频",
-            "图片",
-            "改",
-            "调整",
-            "修改",
-            "连接",
-            "运行",
-        )
-        if (
-            interaction_mode == "plan"
-            and allow_canvas_tools
-            and t_compact
-            and len(t_compact) <= 8
-            and not any(k in t_compact for k in creation_hints)
-        ):
+    last_user_text = _get_last_user_text(state)
+    t = last_user_text.strip()
+    # Collapse whitespace
+    t_compact = " ".join(t.split())
+
+    if interaction_mode == "plan" and allow_canvas_tools:
+        if not _EXPLICIT_EXECUTE_HINTS_RE.search(t_compact):
             allow_canvas_tools = False
-            allow_canvas_tools_reason = "用户输入过短且未表达明确创作动作，先用选项确认下一步。"
-    except Exception:
-        pass
+            allow_canvas_tools_reason = "Plan 模式：按步骤询问确认，本轮不自动执行画布工具。"
+            tool_tier = "none"
+
+    if (
+        interaction_mode == "plan"
+        and allow_canvas_tools
+        and t_compact
+        and len(t_compact) <= 8
+        and not _CREATION_HINTS_RE.search(t_compact)
+    ):
+        allow_canvas_tools = False
+        allow_canvas_tools_reason = "用户输入过短且未表达明确创作动作，先用选项确认下一步。"
 
     # ensure defaults for downstream (even though web research removed)
     defaults = {
@@ -1638,10 +2615,251 @@ def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
         "active_intent": intent or "",
         "active_tool_tier": tool_tier,
         "request_started_at": request_started_at,
+        "canvas_context_text": canvas_context_text,
         **{k: v for k, v in defaults.items() if k not in state},
     }
 
 
+def _apply_timeout_fallback(state: OverallState, text: str) -> str:
+    """Answer text to show when the model call timed out, built from whatever the turn already has."""
+    base = (text or "").strip()
+    if base:
+        return (
+            base
+            + "\n\n结论：生成超时，先给出当前可用结论。如需更完整细节，请让我继续。"
+        )
+    summary = ""
+    for s in state.get("web_research_result") or []:
+        if isinstance(s, str) and s.strip():
+            summary = s.strip()
+            break
+    if summary:
+        summary = " ".join(summary.split())
+        if len(summary) > 400:
+            summary = summary[:400].rstrip() + "…"
+        return (
+            f"结论：{summary}\n\n（生成超时，先给结论。如需更完整细节，请让我继续。）"
+        )
+    topic = _get_research_topic_with_summary(state, tail=8).strip()
+    if topic:
+        topic = " ".join(topic.split())
+        if len(topic) > 240:
+            topic = topic[:240].rstrip() + "…"
+        return (
+            f"结论：{topic}\n\n（生成超时，先给结论。如需更完整细节，请让我继续。）"
+        )
+    return "结论：生成超时，先给结论。当前信息不足，建议拆分问题或补充关键细节后继续。"
+
+
+def _normalize_tapcanvas_actions(obj: object) -> list[dict] | None:
+    actions = obj.get("actions") if isinstance(obj, dict) else None
+    if not isinstance(actions, list):
+        return None
+    normalized: list[dict] = []
+    for item in actions:
+        if not isinstance(item, dict):
+            continue
+        label = item.get("label")
+        input_text = item.get("input")
+        if not isinstance(label, str) or not label.strip():
+            continue
+        if not isinstance(input_text, str) or not input_text.strip():
+            continue
+        normalized.append({"label": label.strip(), "input": input_text})
+        if len(normalized) >= 6:
+            break
+    return normalized or None
+
+
+def _extract_json_object(s: str, start_index: int) -> tuple[str, int] | None:
+    """Return (json_text, end_index_exclusive) for a JSON object starting at/after start_index."""
+    start = s.find("{", start_index)
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    quote = ""
+    i = start
+    while i < len(s):
+        ch = s[i]
+        if in_string:
+            if ch == "\\":
+                i += 2
+                continue
+            if ch == quote:
+                in_string = False
+                quote = ""
+            i += 1
+            continue
+        if ch in ('"', "'"):
+            in_string = True
+            quote = ch
+            i += 1
+            continue
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return s[start : i + 1].strip(), i + 1
+        i += 1
+    return None
+
+
+def _extract_tapcanvas_actions(text: str) -> tuple[str, list[dict] | None]:
+    if not isinstance(text, str):
+        return text, None
+
+    cleaned = text
+    obj: object | None = None
+
+    # Preferred: fenced block (per prompt convention).
+    fenced = _TAPCANVAS_RE.search(text)
+    if fenced is not None:
+        cleaned = (text[: fenced.start()] + text[fenced.end() :]).strip()
+        try:
+            obj = orjson.loads(fenced.group(1))
+        except Exception:
+            obj = None
+
+    # Fallback: plain marker + JSON (some models omit the code fence and may append extra text after JSON).
+    if obj is None and "tapcanvas_actions" in text:
+        token = "tapcanvas_actions"
+        token_idx = text.find(token)
+        while token_idx >= 0:
+            if token_idx == 0 or text[token_idx - 1] == "\n":
+                break
+            token_idx = text.find(token, token_idx + len(token))
+        if token_idx >= 0:
+            extracted = _extract_json_object(text, token_idx + len(token))
+            if extracted:
+                payload_raw, end_index = extracted
+                remove_start = token_idx - 1 if token_idx > 0 and text[token_idx - 1] == "\n" else token_idx
+                cleaned = (text[:remove_start] + text[end_index:]).strip()
+                try:
+                    obj = orjson.loads(payload_raw)
+                except Exception:
+                    obj = None
+
+    if obj is None:
+        return cleaned, None
+
+    normalized = _normalize_tapcanvas_actions(obj)
+    return cleaned, normalized
+
+
+def _three_view_prompt(n: str) -> str:
+    return (
+        "日漫2D角色设定图，三视图同画面（正面/侧面/背面），全身站姿，比例统一，三视同一身高与肩宽，脸型五官一致，"
+        "发型轮廓一致；线条干净，赛璐璐平涂，少量高光与阴影；纯浅灰背景；脚底对齐同一地面线；"
+        "清晰服装结构与褶皱逻辑；适合后续分镜复用。\n"
+        f"角色：{n}。\n"
+        "风格：民俗志怪+现实荒诞的日漫2D，克制写实（非Q版）。\n"
+        "要求：不要换脸、不要换衣服、不要改变发型分缝；三视一致。"
+    )
+
+
+def _classify_safety(
+    model: str,
+    prefetched: concurrent.futures.Future | None,
+    user_text: str,
+    planned_prompts: str,
+) -> SafetyDecision:
+    """Safety verdict for this turn; uses the prefetched user-only verdict when no prompts were planned."""
+    try:
+        if prefetched is not None and not planned_prompts:
+            return prefetched.result()
+        return _classify_safety_decision(model, user_text, planned_prompts)
+    except Exception:
+        # Fallback: assume safe but keep sanitization enabled in prompts via negativePrompt.
+        return SafetyDecision.model_construct(
+            sexual=False,
+            nudity=False,
+            gore=False,
+            violence=False,
+            should_block=False,
+            should_sanitize=True,
+            reason="Fallback: classifier unavailable.",
+        )
+
+
+_IMAGE_NODE_KINDS = frozenset({"image", "textToImage", "mosaic"})
+
+
+def _rendered_image_label(n: object) -> str | None:
+    """Stripped label of a canvas-context image node that rendered successfully, else None."""
+    if not isinstance(n, dict) or n.get("status") != "success":
+        return None
+    kind = n.get("kind") or n.get("type")
+    if not isinstance(kind, str) or kind not in _IMAGE_NODE_KINDS:
+        return None
+    image_url = n.get("imageUrl")
+    if not isinstance(image_url, str) or not image_url.strip():
+        return None
+    label = n.get("label")
+    if not isinstance(label, str):
+        return None
+    return label.strip() or None
+
+
+def _pick_reference_image_labels_from_canvas_context(
+    canvas_context_obj: dict | None, storyboard_label: str
+) -> list[str]:
+    if not isinstance(canvas_context_obj, dict):
+        return []
+    nodes_ctx = canvas_context_obj.get("nodes")
+    if not isinstance(nodes_ctx, list) or not nodes_ctx:
+        return []
+    # One forward pass over eligible (successful, rendered) image nodes:
+    # 1) the most recent storyboard image is the continuity anchor (previous episode/segment);
+    # 2) subject anchors (characters/products/key props) fill the remaining slots,
+    # excluding storyboard/video nodes to avoid over-weighting structure over subject identity.
+    storyboard_anchor: str | None = None
+    candidates: list[tuple[int, int, str]] = []
+    for idx, n in enumerate(nodes_ctx):
+        label = _rendered_image_label(n)
+        if not label or label == storyboard_label:
+            continue
+        if _STORYBOARD_HINT_RE.search(f"{label}\n{n.get('promptPreview') or ''}"):
+            storyboard_anchor = label
+        if _STORYBOARD_OR_VIDEO_LABEL_RE.search(label):
+            continue
+        score = 0
+        if _CHARACTER_LABEL_RE.search(label):
+            score += 3
+        # Products / key props hints
+        if _PROP_LABEL_RE.search(label):
+            score += 2
+        if _ANIMAL_LABEL_RE.search(label.lower()):
+            score += 2
+        candidates.append((score, idx, label))
+    candidates.sort(key=lambda t: (t[0], t[1]), reverse=True)
+    picked: list[str] = []
+    if storyboard_anchor:
+        picked.append(storyboard_anchor)
+    for _, _, label in candidates:
+        if label in picked:
+            continue
+        picked.append(label)
+        if len(picked) >= 3:
+            break
+    return picked[:3]
+
+
+def _pick_latest_success_image_label(canvas_context_obj: dict | None) -> str | None:
+    if not isinstance(canvas_context_obj, dict):
+        return None
+    nodes_ctx = canvas_context_obj.get("nodes")
+    if not isinstance(nodes_ctx, list) or not nodes_ctx:
+        return None
+    # iterate from latest to oldest
+    for n in reversed(nodes_ctx):
+        label = _rendered_image_label(n)
+        if label and not _STORYBOARD_LABEL_RE.search(label):
+            return label
+    return None
+
+
 # Nodes
 @traceable
 def finalize_answer(state: OverallState, config: RunnableConfig):
@@ -1678,176 +2896,40 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
 
     # Format the prompt
     current_date = get_current_date()
-    canvas_context = state.get("canvas_context")
-    canvas_context_text = _render_canvas_context_for_prompt(canvas_context)
+    canvas_context_text = _canvas_context_text(state)
     interaction_mode = state.get("interaction_mode")
     if interaction_mode not in ("agent", "agent_max", "plan"):
         interaction_mode = "agent"
-    formatted_prompt = answer_instructions.format(
+    # Rendered once for the answer prompt; the timeout fallback builds its own shorter (tail=8) topic.
+    research_topic = _get_research_topic_with_summary(state, tail=16)
+    summaries_text = "\n---\n\n".join(state["web_research_result"])
+    formatted_prompt = _ANSWER_PROMPT(
         current_date=current_date,
         interaction_mode=interaction_mode,
-        research_topic=_get_research_topic_with_summary(state, tail=16),
+        research_topic=research_topic,
         role_directive=role_directive,
-        summaries="\n---\n\n".join(state["web_research_result"]),
+        summaries=summaries_text,
         canvas_context=canvas_context_text,
     )
     tool_calls_payload: list[dict] = []
     llm_error_payload: dict | None = None
     quick_replies_payload: list[dict] | None = None
 
-    def _apply_timeout_fallback(text: str) -> str:
-        base = (text or "").strip()
-        if base:
-            return (
-                base
-                + "\n\n结论：生成超时，先给出当前可用结论。如需更完整细节，请让我继续。"
-            )
-        summary = ""
-        for s in state.get("web_research_result") or []:
-            if isinstance(s, str) and s.strip():
-                summary = s.strip()
-                break
-        if summary:
-            summary = " ".join(summary.split())
-            if len(summary) > 400:
-                summary = summary[:400].rstrip() + "…"
-            return (
-                f"结论：{summary}\n\n（生成超时，先给结论。如需更完整细节，请让我继续。）"
-            )
-        topic = _get_research_topic_with_summary(state, tail=8).strip()
-        if topic:
-            topic = " ".join(topic.split())
-            if len(topic) > 240:
-                topic = topic[:240].rstrip() + "…"
-            return (
-                f"结论：{topic}\n\n（生成超时，先给结论。如需更完整细节，请让我继续。）"
-            )
-        return "结论：生成超时，先给结论。当前信息不足，建议拆分问题或补充关键细节后继续。"
-
-    def _extract_tapcanvas_actions(text: str) -> tuple[str, list[dict] | None]:
-        if not isinstance(text, str):
-            return text, None
-
-        def _normalize_actions(obj: object) -> list[dict] | None:
-            actions = obj.get("actions") if isinstance(obj, dict) else None
-            if not isinstance(actions, list):
-                return None
-            normalized: list[dict] = []
-            for item in actions:
-                if not isinstance(item, dict):
-                    continue
-                label = item.get("label")
-                input_text = item.get("input")
-                if not isinstance(label, str) or not label.strip():
-                    continue
-                if not isinstance(input_text, str) or not input_text.strip():
-                    continue
-                normalized.append({"label": label.strip(), "input": input_text})
-                if len(normalized) >= 6:
-                    break
-            return normalized or None
-
-        def _extract_json_object(s: str, start_index: int) -> tuple[str, int] | None:
-            """Return (json_text, end_index_exclusive) for a JSON object starting at/after start_index."""
-            start = s.find("{", start_index)
-            if start < 0:
-                return None
-            depth = 0
-            in_string = False
-            quote = ""
-            i = start
-            while i < len(s):
-                ch = s[i]
-                if in_string:
-                    if ch == "\\":
-                        i += 2
-                        continue
-                    if ch == quote:
-                        in_string = False
-                        quote = ""
-                    i += 1
-                    continue
-                if ch in ('"', "'"):
-                    in_string = True
-                    quote = ch
-                    i += 1
-                    continue
-                if ch == "{":
-                    depth += 1
-                elif ch == "}":
-                    depth -= 1
-                    if depth == 0:
-                        return s[start : i + 1].strip(), i + 1
-                i += 1
-            return None
-
-        cleaned = text
-        obj: object | None = None
-
-        # Preferred: fenced block (per prompt convention).
-        marker = "```tapcanvas_actions"
-        start = text.find(marker)
-        if start >= 0:
-            start_payload = text.find("\n", start + len(marker))
-            if start_payload >= 0:
-                start_payload += 1
-                end_fence = text.find("```", start_payload)
-                if end_fence >= 0:
-                    payload_raw = text[start_payload:end_fence].strip()
-                    cleaned = (text[:start] + text[end_fence + 3 :]).strip()
-                    try:
-                        obj = json.loads(payload_raw)
-                    except Exception:
-                        obj = None
-
-        # Fallback: plain marker + JSON (some models omit the code fence and may append extra text after JSON).
-        if obj is None and "tapcanvas_actions" in text:
-            token = "tapcanvas_actions"
-            token_idx = text.find(token)
-            while token_idx >= 0:
-                if token_idx == 0 or text[token_idx - 1] == "\n":
-                    break
-                token_idx = text.find(token, token_idx + len(token))
-            if token_idx >= 0:
-                extracted = _extract_json_object(text, token_idx + len(token))
-                if extracted:
-                    payload_raw, end_index = extracted
-                    remove_start = token_idx - 1 if token_idx > 0 and text[token_idx - 1] == "\n" else token_idx
-                    cleaned = (text[:remove_start] + text[end_index:]).strip()
-                    try:
-                        obj = json.loads(payload_raw)
-                    except Exception:
-                        obj = None
-
-        if obj is None:
-            return cleaned, None
-
-        normalized = _normalize_actions(obj)
-        return cleaned, normalized
-
     allow_canvas_tools = bool(state.get("allow_canvas_tools", True))
     role_tools = _tool_definitions_for_role(resolved_id, allow_canvas_tools)
+    # The latest user message is read by several gates below; bind and scan it once for the node.
+    last_user_text = _get_last_user_text(state)
+    gate_flags = _user_gate_flags(last_user_text)
 
     # Fast path: when user pastes a long story in Agent/Agent Max, deterministically run
     # the character->storyboard->video pipeline instead of relying on the LLM to emit tool calls.
     # This avoids truncated tool-call JSON and makes the workflow repeatable/dedupable.
     try:
-        last_user_text = _get_last_user_text(state)
         if (
             allow_canvas_tools
             and interaction_mode in ("agent", "agent_max")
             and _looks_like_story_request(last_user_text)
-            and not any(
-                k in (last_user_text or "")
-                for k in (
-                    "先不操作画布",
-                    "不要操作画布",
-                    "只聊",
-                    "只写",
-                    "不要生成",
-                    "不生成",
-                )
-            )
+            and not gate_flags & _GATE_CANVAS_OPT_OUT
         ):
             tool_calls_payload, content = _synthesize_story_pipeline_tool_calls(
                 state,
@@ -1879,15 +2961,16 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
         pass
 
     if llm_provider == "openai":
+        safety_model = getattr(configurable, "safety_classifier_model", None) or configurable.role_selector_model
+        # Without canvas tools no planned prompts can appear, so the safety classifier's input is
+        # already known: run it concurrently with the answer call instead of after it.
+        safety_future = None
+        if not allow_canvas_tools:
+            safety_future = _prefetch_safety_decision(safety_model, last_user_text)
         try:
             kwargs: dict = {
                 "model": reasoning_model,
-                "input": [
-                    {
-                        "role": "user",
-                        "content": [{"type": "input_text", "text": formatted_prompt}],
-                    }
-                ],
+                "input": _responses_input(formatted_prompt),
                 "stream": True,
             }
             if role_tools:
@@ -1901,7 +2984,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                     max_seconds=600,
                 )
                 if timed_out:
-                    result_text = _apply_timeout_fallback(result_text)
+                    result_text = _apply_timeout_fallback(state, result_text)
                     tool_calls_payload = []
                 tool_calls_payload = _normalize_tool_calls_payload(tool_calls_payload)
                 tool_calls_payload = _filter_tool_calls_by_role(tool_calls_payload, resolved_id, allow_canvas_tools)
@@ -1911,7 +2994,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                 client = get_openai_client()
                 chat_kwargs: dict = {
                     "model": reasoning_model,
-                    "messages": [{"role": "user", "content": formatted_prompt}],
+                    "messages": _chat_messages(formatted_prompt),
                     "temperature": 0,
                 }
                 chat_tools = _to_chat_completions_tools(role_tools)
@@ -1928,7 +3011,6 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             # Story -> characters -> storyboard -> video autopipeline
             # Trigger when user pastes long story text and asks for animation/storyboard/video.
             try:
-                last_user_text = _get_last_user_text(state)
                 if (
                     allow_canvas_tools
                     and interaction_mode in ("agent", "agent_max")
@@ -1952,22 +3034,14 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                 and not tool_calls_payload
             ):
                 try:
-                    last_user_text = ""
-                    try:
-                        for m in reversed(state.get("messages") or []):
-                            if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-                                last_user_text = str(getattr(m, "content", "") or "")
-                                break
-                    except Exception:
-                        last_user_text = ""
-                    t = (last_user_text or "").strip()
+                    t = last_user_text.strip()
                     if any(k in t for k in ("三视", "三视图", "角色三视", "角色三视图")):
                         # Infer character names from recent user text (best-effort).
                         recent_user_text = ""
                         try:
                             user_msgs = []
                             for m in (state.get("messages") or [])[-12:]:
-                                if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
+                                if _is_user_message(m):
                                     user_msgs.append(str(getattr(m, "content", "") or ""))
                             recent_user_text = "\n".join(user_msgs)
                         except Exception:
@@ -1992,16 +3066,6 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                         if not names:
                             names = ["主角"]
 
-                        def _three_view_prompt(n: str) -> str:
-                            return (
-                                "日漫2D角色设定图，三视图同画面（正面/侧面/背面），全身站姿，比例统一，三视同一身高与肩宽，脸型五官一致，"
-                                "发型轮廓一致；线条干净，赛璐璐平涂，少量高光与阴影；纯浅灰背景；脚底对齐同一地面线；"
-                                "清晰服装结构与褶皱逻辑；适合后续分镜复用。\n"
-                                f"角色：{n}。\n"
-                                "风格：民俗志怪+现实荒诞的日漫2D，克制写实（非Q版）。\n"
-                                "要求：不要换脸、不要换衣服、不要改变发型分缝；三视一致。"
-                            )
-
                         negative = (
                             "写实3D, 真人照片风, Q版, 夸张大眼幼态, 换脸, 换发型, 换衣服, 多余人物, 多张脸, "
                             "背景复杂, 血腥细节, 肢体缺失, 手指畸形"
@@ -2029,178 +3093,47 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                 except Exception:
                     pass
 
-            # If the user is asking for open-ended story continuation recommendations,
-            # do NOT auto-create storyboard/video nodes in this turn; offer selectable directions.
-            last_user_text = ""
-            try:
-                for m in reversed(state.get("messages") or []):
-                    if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-                        last_user_text = str(getattr(m, "content", "") or "")
-                        break
-            except Exception:
-                last_user_text = ""
-
             # Always-on "magician" content safety:
             # - Safety classification should be decided by an LLM (not brittle keyword lists).
             # - We only use lightweight sanitization transforms AFTER classification.
-            def _classify_safety(user_text: str, planned_prompts: str) -> SafetyDecision:
-                model = getattr(configurable, "safety_classifier_model", None) or configurable.role_selector_model
-                payload = (
-                    "You are a strict-but-practical content safety classifier for a public creative tool.\n"
-                    "Task: judge whether the request/planned prompts contain explicit sexual content, explicit nudity, graphic gore, or explicit violence.\n"
-                    "Rules:\n"
-                    "- sexual=true only for explicit sexual acts/pornographic intent.\n"
-                    "- nudity=true if explicit nudity is requested or described for output.\n"
-                    "- gore=true only for graphic body harm/viscera/dismemberment close-ups.\n"
-                    "- violence=true for explicit harm descriptions that should be softened to PG-13 cinematic implication.\n"
-                    "- should_block=true if the assistant must refuse direct generation and ask to rewrite first (typically sexual/porn; or extreme gore).\n"
-                    "- should_sanitize=true if output should be rewritten/softened (PG-13) before proceeding.\n"
-                    "Return a JSON object matching the provided schema.\n\n"
-                    "USER_TEXT:\n"
-                    f"{(user_text or '').strip()}\n\n"
-                    "PLANNED_PROMPTS (may be empty):\n"
-                    f"{(planned_prompts or '').strip()}\n"
-                )
-                try:
-                    return _call_openai_structured(model, payload, SafetyDecision)
-                except Exception:
-                    # Fallback: assume safe but keep sanitization enabled in prompts via negativePrompt.
-                    return SafetyDecision(
-                        sexual=False,
-                        nudity=False,
-                        gore=False,
-                        violence=False,
-                        should_block=False,
-                        should_sanitize=True,
-                        reason="Fallback: classifier unavailable.",
-                    )
-
-            def _sanitize_sexual_text(text: str) -> str:
-                if not isinstance(text, str) or not text.strip():
-                    return text
-                replacements = {
-                    "无码": "（不展示细节）",
-                    "露点": "穿着完整（不露骨）",
-                    "裸体": "穿着完整（不露骨）",
-                    "性交": "亲密互动（不露骨）",
-                    "做爱": "亲密互动（不露骨）",
-                    "口交": "亲密互动（不露骨）",
-                    "肛交": "亲密互动（不露骨）",
-                    "强奸": "性侵（不展示细节，仅点到为止）",
-                    "迷奸": "性侵（不展示细节，仅点到为止）",
-                    "porn": "（不露骨）",
-                }
-                out = text
-                for k, v in replacements.items():
-                    out = out.replace(k, v)
-                return out
-
-            def _sanitize_violent_text(text: str) -> str:
-                if not isinstance(text, str) or not text.strip():
-                    return text
-                replacements = {
-                    "爆头": "强烈冲击（不展示细节）",
-                    "脑浆": "冲击性的后果（不展示细节）",
-                    "断肢": "受伤倒下（不展示细节）",
-                    "肢解": "镜头切走（用暗示表达）",
-                    "开膛": "镜头切走（用暗示表达）",
-                    "剖腹": "镜头切走（用暗示表达）",
-                    "内脏": "不展示细节",
-                    "肠子": "不展示细节",
-                    "碎尸": "不展示细节",
-                    "割喉": "镜头切走（用暗示表达）",
-                    "斩首": "镜头切走（用暗示表达）",
-                    "砍头": "镜头切走（用暗示表达）",
-                    "喷血": "用剪影/反应镜头表达冲击（不展示细节）",
-                    "血浆": "用光影/音效表达冲击（不展示细节）",
-                    "血肉模糊": "画面用遮挡/虚焦表达（不展示细节）",
-                }
-                out = text
-                for k, v in replacements.items():
-                    out = out.replace(k, v)
-                return out
-
-            tool_prompts_text = ""
-            try:
-                for c in tool_calls_payload or []:
-                    if c.get("name") != "createNode":
-                        continue
-                    args = c.get("arguments") or {}
-                    cfg = args.get("config")
-                    if isinstance(cfg, dict):
-                        p = cfg.get("prompt")
-                        if isinstance(p, str) and p.strip():
-                            tool_prompts_text += "\n" + p
-            except Exception:
-                pass
-            safety = _classify_safety(last_user_text or "", tool_prompts_text)
+            # createNode calls with a config, extracted once for the safety passes below.
+            node_configs = [v.cfg for v in _norm_calls(tool_calls_payload) if v.name == "createNode" and v.cfg is not None]
+            tool_prompts_text = "\n".join(
+                p for p in (cfg.get("prompt") for cfg in node_configs) if isinstance(p, str) and p.strip()
+            )
+            safety = _classify_safety(safety_model, safety_future, last_user_text, tool_prompts_text)
 
             if safety.should_block and (safety.sexual or safety.nudity):
                 tool_calls_payload = []
-                quick_replies_payload = [
-                    {
-                        "label": "改成含蓄浪漫（不露骨）",
-                        "input": "把刚才的内容改写成含蓄浪漫、PG-13表达：不出现裸体/性行为/露骨描写，用暗示与情绪推进；然后再生成九宫格分镜。",
-                    },
-                    {
-                        "label": "改成亲密但克制",
-                        "input": "把亲密内容改成拥抱/牵手/靠近等克制表达（不涉及色情），强调关系与情绪；然后再生成分镜/视频。",
-                    },
-                    {
-                        "label": "只保留剧情，不生成画面",
-                        "input": "先不要生成画面。把内容改成适合大众平台的剧情梗概（不露骨），并给我3个可选走向按钮。",
-                    },
-                    {
-                        "label": "我只是要分镜（无色情）",
-                        "input": "我这段没有色情/裸露/性行为内容，只是要做分镜与提示词；请按原剧情继续生成九宫格分镜与统一提示词，并在提示词里明确：无裸露、无性行为、PG-13。",
-                    },
-                ]
+                quick_replies_payload = _quick_replies(_QR_SEXUAL_BLOCKED)
                 result_text = (
                     "内容安全检查判定为需要先降级到 PG-13（不露骨、不裸露）。"
                     "我不会生成露骨色情内容；可以先把表达改成含蓄、电影化暗示再继续做分镜/视频。点一个按钮继续。"
                 )
             elif safety.should_sanitize and (safety.sexual or safety.nudity):
                 # Sanitize prompts and add safety negatives, but do not hard-block the whole turn.
-                try:
-                    for c in tool_calls_payload or []:
-                        if c.get("name") != "createNode":
-                            continue
-                        args = c.get("arguments") or {}
-                        cfg = args.get("config")
-                        if not isinstance(cfg, dict):
-                            continue
-                        if isinstance(cfg.get("prompt"), str):
-                            cfg["prompt"] = _sanitize_sexual_text(cfg["prompt"])
-                        neg = cfg.get("negativePrompt")
-                        neg_text = neg if isinstance(neg, str) else ""
-                        add_neg = "nude, naked, explicit sex, porn, nipples, genitalia"
-                        if add_neg not in neg_text:
-                            cfg["negativePrompt"] = (neg_text + ("\n" if neg_text else "") + add_neg).strip()
-                except Exception:
-                    pass
+                for cfg in node_configs:
+                    prompt = cfg.get("prompt")
+                    if isinstance(prompt, str):
+                        sanitized = _sanitize_sexual_text(prompt)
+                        if sanitized is not prompt:
+                            cfg["prompt"] = sanitized
+                    _append_negative_prompt(cfg, _SEXUAL_NEGATIVE_PROMPT)
             elif safety.should_sanitize and (safety.gore or safety.violence):
                 result_text = _sanitize_violent_text(result_text or "")
-                try:
-                    for c in tool_calls_payload or []:
-                        if c.get("name") != "createNode":
-                            continue
-                        args = c.get("arguments") or {}
-                        cfg = args.get("config")
-                        if not isinstance(cfg, dict):
-                            continue
-                        if isinstance(cfg.get("prompt"), str):
-                            cfg["prompt"] = _sanitize_violent_text(cfg["prompt"])
-                        neg = cfg.get("negativePrompt")
-                        neg_text = neg if isinstance(neg, str) else ""
-                        add_neg = "gore, dismemberment, intestines, brains, blood splatter close-up, explicit violence, torture porn, nude, explicit sex"
-                        if add_neg not in neg_text:
-                            cfg["negativePrompt"] = (neg_text + ("\n" if neg_text else "") + add_neg).strip()
-                except Exception:
-                    pass
+                for cfg in node_configs:
+                    prompt = cfg.get("prompt")
+                    if isinstance(prompt, str):
+                        sanitized = _sanitize_violent_text(prompt)
+                        if sanitized is not prompt:
+                            cfg["prompt"] = sanitized
+                    _append_negative_prompt(cfg, _GORE_NEGATIVE_PROMPT)
+            # If the user is asking for open-ended story continuation recommendations,
+            # do NOT auto-create storyboard/video nodes in this turn; offer selectable directions.
             is_story_suggestion_request = (
-                any(k in (last_user_text or "") for k in ("续写", "后续剧情", "接下来", "续作"))
-                and any(k in (last_user_text or "") for k in ("推荐", "方向", "灵感", "怎么写"))
-                and not any(k in (last_user_text or "") for k in ("九宫格", "分镜", "故事板", "storyboard", "15s"))
+                bool(gate_flags & _GATE_SUGGEST_CONTINUE)
+                and bool(gate_flags & _GATE_SUGGEST_ASK)
+                and not gate_flags & _GATE_STORYBOARD_WORDS
             )
 
             if (
@@ -2210,31 +3143,14 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             ):
                 # Prevent unintended canvas actions triggered by the model.
                 tool_calls_payload = []
-                quick_replies_payload = [
-                    {
-                        "label": "方向A：暖心日常",
-                        "input": "我选择方向A（暖心日常）：请基于当前项目已有剧情与角色关系（沿用同一世界观/场景/氛围）续写下一段 15 秒的小故事。先给我紧凑剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
-                    },
-                    {
-                        "label": "方向B：轻冒险任务",
-                        "input": "我选择方向B（轻冒险任务）：请基于当前项目已有剧情续写，加入一个小目标/小危机但保持治愈基调。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
-                    },
-                    {
-                        "label": "方向C：小悬疑反转",
-                        "input": "我选择方向C（小悬疑反转）：请基于当前项目已有剧情续写，前半段制造小谜团，结尾温暖反转（不要跳出既有设定）。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
-                    },
-                    {
-                        "label": "自定义方向…",
-                        "input": "我想自定义续写方向（基于当前项目已有剧情，不要另起炉灶）：\n- 主题/情绪：\n- 场景：\n- 关键事件：\n- 结尾落点：\n请基于我的填写先给梗概，再做九宫格分镜与15s视频。",
-                    },
-                ]
+                quick_replies_payload = _quick_replies(_QR_STORY_DIRECTIONS)
                 result_text = "给你 3 个续写方向，点一个我就按这个继续写；也可以选“自定义方向”把你想要的走向填进去。"
 
             # Storyboard/video continuity gate:
             # To avoid abrupt scene drift and accidental new subjects, require an explicit "lock" confirmation
             # before creating storyboard/video nodes, unless the user already confirmed.
             has_canvas_tool_calls = any(
-                (c.get("name") in ("createNode", "updateNode", "connectNodes", "runNode"))
+                (c.get("name") in _CANVAS_TOOL_NAMES)
                 for c in (tool_calls_payload or [])
                 if isinstance(c, dict)
             )
@@ -2243,20 +3159,11 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             # for text-only deliverables like scripts, character sheets, or shot lists.
             storyboard_generation_intent = (
                 has_canvas_tool_calls
-                or any(k in (last_user_text or "") for k in ("九宫格", "分镜图", "故事板", "storyboard"))
-                or (
-                    any(k in (last_user_text or "") for k in ("生成", "出", "做成"))
-                    and any(k in (last_user_text or "") for k in ("分镜", "九宫格", "故事板", "图片", "生图", "视频", "15s", "15秒"))
-                )
-            )
-            has_lock_confirmation = any(
-                k in (last_user_text or "")
-                for k in ("确认锁定", "锁定场景", "锁定主体", "锁定风格", "确认风格", "风格锁定", "我确认", "确认：")
-            )
-            implicit_lock_confirmation = any(
-                k in (last_user_text or "")
-                for k in ("继续", "按你给的", "就按这个", "照这个来", "不用确认", "直接生成", "别问了")
+                or bool(gate_flags & _GATE_STORYBOARD_REQUEST)
+                or (bool(gate_flags & _GATE_GENERATE_VERB) and bool(gate_flags & _GATE_GENERATE_OUTPUT))
             )
+            has_lock_confirmation = bool(gate_flags & _GATE_LOCK_EXPLICIT)
+            implicit_lock_confirmation = bool(gate_flags & _GATE_LOCK_IMPLICIT)
             # Hard fallback to prevent self-looping: after N turns in the same thread,
             # stop blocking on lock confirmation and proceed with default lock behavior.
             if hard_turn_cap > 0 and agent_loop_count >= hard_turn_cap:
@@ -2267,68 +3174,15 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                 # Agent mode: proceed without additional lock-confirm steps.
                 has_lock_confirmation = True
 
-            def _extract_style_lock_from_messages(messages_obj: list | None) -> str | None:
-                if not isinstance(messages_obj, list):
-                    return None
-                for m in reversed(messages_obj):
-                    # Prefer user confirmations
-                    if getattr(m, "type", None) != "human" and getattr(m, "role", None) != "user":
-                        continue
-                    text = str(getattr(m, "content", "") or "")
-                    if not text:
-                        continue
-                    for key in ("确认锁定风格：", "风格锁定：", "锁定风格："):
-                        if key in text:
-                            after = text.split(key, 1)[1].strip()
-                            if not after:
-                                continue
-                            first_line = after.splitlines()[0].strip()
-                            return first_line[:80] if first_line else None
-                return None
-
-            style_lock = _extract_style_lock_from_messages(state.get("messages") or [])
             if storyboard_generation_intent and not has_lock_confirmation and not is_story_suggestion_request:
                 # Convert any accidental tool calls into a "plan" with buttons for user confirmation.
                 tool_calls_payload = []
                 if not quick_replies_payload:
+                    style_lock = _extract_style_lock_from_messages(state.get("messages") or [])
                     if not style_lock:
-                        quick_replies_payload = [
-                            {
-                                "label": "继续（锁定+先做角色设定图）",
-                                "input": "确认锁定风格：日漫2D（干净线稿+赛璐璐）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。\n第一步：先为所有主要角色生成可复现的角色设定图/参考图（character/image 节点），并把这些参考图连到后续分镜节点作为引用。\n第二步：再生成 3x3 九宫格分镜图。",
-                            },
-                            {
-                                "label": "锁定风格：美漫2D（粗线条）",
-                                "input": "确认锁定风格：美漫2D（粗线条+高对比）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。\n第一步：先为所有主要角色生成可复现的角色设定图/参考图（character/image 节点），并把这些参考图连到后续分镜节点作为引用。\n第二步：再生成 3x3 九宫格分镜图。",
-                            },
-                            {
-                                "label": "锁定风格：写实真人",
-                                "input": "确认锁定风格：写实真人（电影质感）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。\n第一步：先为所有主要角色生成可复现的角色设定图/参考图（character/image 节点），并把这些参考图连到后续分镜节点作为引用。\n第二步：再生成 3x3 九宫格分镜图。",
-                            },
-                            {
-                                "label": "自定义风格…",
-                                "input": "确认锁定风格：\n- 风格类型（2D日漫/2D美漫/写实/其他）：\n- 线条/材质：\n- 色彩与光影：\n- 镜头语言：\n同时：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。填写后请生成 3x3 九宫格分镜图并连线参考图。",
-                            },
-                        ]
+                        quick_replies_payload = _quick_replies(_QR_LOCK_DEFAULT)
                     else:
-                        quick_replies_payload = [
-                            {
-                                "label": "继续（按已锁定风格生成分镜）",
-                                "input": f"确认锁定风格：{style_lock}。确认锁定：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（主角数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
-                            },
-                            {
-                                "label": "新增主体…（先出设定图）",
-                                "input": "我要新增主体（角色/产品/关键道具）：\n- 主体1：\n- 主体2：\n要求：先分别生成每个主体的设定图（image），等我确认后再生成九宫格分镜并连线消费这些设定图。",
-                            },
-                            {
-                                "label": "改场景…（先锁定场景图）",
-                                "input": "我想锁定新的主场景：\n- 场景描述：\n要求：先生成一张“场景设定图”（image）给我确认；确认后九宫格分镜必须只在该场景内推进（光线连续），再生成15s视频。",
-                            },
-                            {
-                                "label": "自定义锁定规则…",
-                                "input": "我想自定义锁定规则：\n- 主场景（只能一个）：\n- 允许的过渡场景（可选）：\n- 主体清单（角色/产品/道具）与数量：\n- 禁止事项：\n请按我的规则先补齐必要的设定图，再生成九宫格分镜并继续。",
-                            },
-                        ]
+                        quick_replies_payload = _quick_replies(_QR_LOCK_STYLE_KNOWN, style_lock=style_lock)
                 if not isinstance(result_text, str) or not result_text.strip():
                     result_text = "为保证叙事连贯，我需要先锁定“主场景 + 主体数量/清单”。点一个选项确认后，我再在画布里生成九宫格分镜并继续成片。"
                 else:
@@ -2342,20 +3196,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             if allow_canvas_tools is False:
                 tool_calls_payload = []
                 if not quick_replies_payload:
-                    quick_replies_payload = [
-                        {
-                            "label": "继续创作（先选方向）",
-                            "input": "基于我当前项目画布，先给 3 个可选方向（按钮）让我选；我选完你再在画布创建分镜/视频节点。",
-                        },
-                        {
-                            "label": "直接生成（我给具体需求）",
-                            "input": "我想在画布生成一个内容：\n- 类型（图片/分镜/视频）：\n- 主题：\n- 风格：\n- 时长/比例（如需要）：\n请按我的填写创建节点并执行。",
-                        },
-                        {
-                            "label": "只聊不操作画布",
-                            "input": "先不操作画布。请先用一句话问我：我想做什么类型的内容、有什么参考、以及希望的风格/时长。",
-                        },
-                    ]
+                    quick_replies_payload = _quick_replies(_QR_CANVAS_TOOLS_OFF)
                 if not isinstance(result_text, str) or not result_text.strip():
                     result_text = "我先不动画布。你想先聊清楚需求，还是直接点一个选项让我开始执行？"
 
@@ -2364,161 +3205,70 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             if tool_calls_payload:
                 # If this is a continuation turn and the assistant introduced a NEW character,
                 # require user confirmation before generating storyboard/video.
-                def _canvas_labels_from_context(canvas_context_obj: dict | None) -> set[str]:
-                    if not isinstance(canvas_context_obj, dict):
-                        return set()
-                    nodes_ctx = canvas_context_obj.get("nodes")
-                    if not isinstance(nodes_ctx, list):
-                        return set()
-                    labels: set[str] = set()
-                    for n in nodes_ctx:
-                        if not isinstance(n, dict):
-                            continue
-                        label = n.get("label")
-                        if isinstance(label, str) and label.strip():
-                            labels.add(label.strip())
-                    return labels
-
                 is_continuation_step = (
-                    any(k in (last_user_text or "") for k in ("我选择方向", "自定义续写", "续写"))
+                    bool(gate_flags & _GATE_CONTINUATION_STEP)
                     and not is_story_suggestion_request
                 )
-                existing_labels = _canvas_labels_from_context(state.get("canvas_context"))
+                # The payload may have been replaced above; extract call fields once for the passes below.
+                calls = _norm_calls(tool_calls_payload)
+                # Edges already on the canvas (as label pairs); read by both reference-connect passes.
+                canvas_edge_pairs: set[tuple[str, str]] | None = None
                 created_image_labels: list[str] = []
                 has_storyboard_create = False
-                for c in tool_calls_payload:
-                    if c.get("name") != "createNode":
+                for v in calls:
+                    if v.name != "createNode" or v.type != "image":
                         continue
-                    args = c.get("arguments") or {}
-                    t = args.get("type")
-                    label = args.get("label")
-                    if isinstance(label, str):
-                        label = label.strip()
-                    else:
-                        label = ""
-                    if t == "image" and label:
-                        created_image_labels.append(label)
-                    if t == "image":
-                        cfg = args.get("config") or {}
-                        prompt = cfg.get("prompt") if isinstance(cfg, dict) else ""
-                        hint = f"{label}\n{prompt}"
-                        if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
-                            has_storyboard_create = True
+                    if v.label:
+                        created_image_labels.append(v.label)
+                    if v.storyboard_hint():
+                        has_storyboard_create = True
 
                 # new character heuristic: created image node with label containing "角色" not previously on canvas
-                new_character_labels = [
-                    lbl
-                    for lbl in created_image_labels
-                    if ("角色" in lbl or "character" in lbl.lower())
-                    and lbl not in existing_labels
-                    and not any(k in lbl for k in ("分镜", "九宫格", "storyboard"))
-                ]
-
-                if is_continuation_step and new_character_labels and has_storyboard_create:
+                new_character_labels: list[str] = []
+                if is_continuation_step and has_storyboard_create:
+                    new_character_labels = [
+                        lbl
+                        for lbl in created_image_labels
+                        if ("角色" in lbl or "character" in lbl.lower())
+                        and not _STORYBOARD_LABEL_RE.search(lbl)
+                    ]
+                    if new_character_labels:
+                        # Only walk the canvas nodes when there is a candidate to check.
+                        existing_labels = _canvas_labels_from_context(state.get("canvas_context"))
+                        new_character_labels = [lbl for lbl in new_character_labels if lbl not in existing_labels]
+
+                if new_character_labels:
                     # Keep only new character creation + its runNode, drop other canvas ops for now.
-                    kept: list[dict] = []
                     keep_set = set(new_character_labels)
-                    for c in tool_calls_payload:
-                        if c.get("name") == "createNode":
-                            args = c.get("arguments") or {}
-                            if (args.get("type") == "image") and isinstance(args.get("label"), str):
-                                if args.get("label").strip() in keep_set:
-                                    kept.append(c)
-                            continue
-                        if c.get("name") == "runNode":
-                            args = c.get("arguments") or {}
-                            node_id = args.get("nodeId")
+                    kept: list[_NormCall] = []
+                    for v in calls:
+                        if v.name == "createNode":
+                            if v.type == "image" and v.label in keep_set:
+                                kept.append(v)
+                        elif v.name == "runNode":
+                            node_id = v.args.get("nodeId")
                             if isinstance(node_id, str) and node_id.strip() in keep_set:
-                                kept.append(c)
-                            continue
-                    tool_calls_payload = kept
+                                kept.append(v)
+                    calls = kept
+                    tool_calls_payload = [v.call for v in kept]
                     # Ask user to confirm character result before proceeding.
-                    quick_replies_payload = [
-                        {
-                            "label": "角色OK，继续分镜",
-                            "input": "新角色我确认OK。请把新角色纳入同一项目设定，基于已有剧情续写下一段，并生成九宫格分镜（image）再连接到15s视频（composeVideo）。",
-                        },
-                        {
-                            "label": "重做这个角色",
-                            "input": "这个新角色不满意。请保持同一角色定位与风格，重做 3 个版本给我选（同一个 image 节点出 3 张即可）。",
-                        },
-                        {
-                            "label": "不要新角色",
-                            "input": "不要新增角色了。请只用现有角色基于已有剧情续写，并生成九宫格分镜与15s视频。",
-                        },
-                    ]
+                    quick_replies_payload = _quick_replies(_QR_NEW_CHARACTER_CONFIRM)
                     result_text = "我先为续写新增了一个角色设定图。你确认角色外观后，我再继续生成续写分镜。"
 
                 # Normalize image creation: prefer `image` over `textToImage` to match the canvas UX.
-                for call in tool_calls_payload:
-                    if call.get("name") != "createNode":
-                        continue
-                    args = call.get("arguments") or {}
-                    node_type = args.get("type")
-                    if node_type != "textToImage":
+                for v in calls:
+                    if v.name != "createNode" or v.type != "textToImage":
                         continue
-                    args["type"] = "image"
-                    cfg = args.get("config")
-                    if isinstance(cfg, dict) and cfg.get("kind") == "textToImage":
-                        cfg["kind"] = "image"
+                    v.args["type"] = v.type = "image"
+                    if v.cfg is not None and v.cfg.get("kind") == "textToImage":
+                        v.cfg["kind"] = "image"
 
                 # Normalize composeVideo: ensure the node has a usable `prompt`.
-                for call in tool_calls_payload:
-                    if call.get("name") != "createNode":
-                        continue
-                    args = call.get("arguments") or {}
-                    node_type = args.get("type")
-                    if node_type != "composeVideo":
+                for v in calls:
+                    if v.name != "createNode" or v.type != "composeVideo" or v.cfg is None:
                         continue
-                    cfg = args.get("config")
-                    if not isinstance(cfg, dict):
-                        continue
-                    # Enforce single-run duration constraint:
-                    # - Default: 10–15 seconds.
-                    # - MiniMax: 6s or 10s.
-                    # If the model requested a longer duration, clamp (and let the UX create additional segments).
-                    try:
-                        model_raw = cfg.get("videoModel") or cfg.get("model") or cfg.get("modelKey") or ""
-                        vendor_raw = cfg.get("videoModelVendor") or cfg.get("vendor") or ""
-                        model_lower = str(model_raw).lower()
-                        vendor_lower = str(vendor_raw).lower()
-                        is_minimax = ("minimax" in vendor_lower) or any(
-                            kw in model_lower for kw in ("minimax", "hailuo", "i2v")
-                        )
-
-                        raw_dur = (
-                            cfg.get("videoDurationSeconds")
-                            if cfg.get("videoDurationSeconds") is not None
-                            else cfg.get("durationSeconds")
-                            if cfg.get("durationSeconds") is not None
-                            else cfg.get("duration")
-                        )
-                        if isinstance(raw_dur, (int, float)):
-                            requested = float(raw_dur)
-                            if is_minimax:
-                                # MiniMax video only supports 6s / 10s.
-                                normalized = 10 if requested >= 8 else 6
-                                cfg["videoDurationSeconds"] = int(normalized)
-                                cfg["durationSeconds"] = int(normalized)
-                            else:
-                                if requested < 10:
-                                    cfg["videoDurationSeconds"] = 10
-                                    cfg["durationSeconds"] = 10
-                                elif requested > 15:
-                                    cfg["videoDurationSeconds"] = 15
-                                    cfg["durationSeconds"] = 15
-                                    # Add a gentle hint so the user can continue with Part 2, without forcing extra nodes.
-                                    if isinstance(cfg.get("prompt"), str) and "分段" not in cfg["prompt"]:
-                                        cfg["prompt"] = (
-                                            cfg["prompt"].rstrip()
-                                            + "\n\n约束：本次为第1段（<=15秒）。如需更长成片，请分段生成第2段/第3段。"
-                                        )
-                                else:
-                                    normalized = int(round(requested))
-                                    cfg["videoDurationSeconds"] = normalized
-                                    cfg["durationSeconds"] = normalized
-                    except Exception:
-                        pass
+                    cfg = v.cfg
+                    _clamp_compose_video_duration(cfg)
                     prompt_val = cfg.get("prompt")
                     if isinstance(prompt_val, str) and prompt_val.strip():
                         continue
@@ -2530,33 +3280,17 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                 # Storyboard workflow: prefer "九宫格分镜图(image) -> composeVideo" (single reference image).
                 # Note: users may ask for "短片/宣传片/产品介绍" without mentioning "分镜/九宫格";
                 # we infer storyboard intent from tool calls as well to keep continuity and auto-connect references.
-                wants_storyboard_by_user = any(
-                    kw in (last_user_text or "")
-                    for kw in ("分镜", "故事板", "storyboard", "九宫格", "15s")
-                )
-                has_compose_video = any(
-                    c.get("name") == "createNode"
-                    and (c.get("arguments") or {}).get("type") == "composeVideo"
-                    for c in tool_calls_payload
-                )
+                wants_storyboard_by_user = bool(gate_flags & _GATE_STORYBOARD_WORDS)
+                has_compose_video = any(v.name == "createNode" and v.type == "composeVideo" for v in calls)
                 storyboard_image_label = None
                 storyboard_image_prompt = None
-                for c in tool_calls_payload:
-                    if c.get("name") != "createNode":
-                        continue
-                    args = c.get("arguments") or {}
-                    if args.get("type") != "image":
+                # Image calls already checked for has_storyboard_create reuse their memoized hint.
+                for v in calls:
+                    if v.name != "createNode" or v.type != "image":
                         continue
-                    cfg = args.get("config") or {}
-                    prompt = cfg.get("prompt") if isinstance(cfg, dict) else None
-                    label = args.get("label")
-                    if isinstance(label, str) and label.strip():
-                        label = label.strip()
-                    else:
-                        label = None
-                    hint = (label or "") + "\n" + (prompt or "")
-                    if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
-                        storyboard_image_label = label
+                    if v.storyboard_hint():
+                        prompt = v.cfg.get("prompt") if v.cfg is not None else None
+                        storyboard_image_label = v.label or None
                         storyboard_image_prompt = prompt if isinstance(prompt, str) else None
                         break
 
@@ -2564,83 +3298,6 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
 
                 # If we are creating a storyboard grid image, connect existing character/reference images
                 # (already generated on canvas) as upstream inputs BEFORE running the storyboard node.
-                def _pick_reference_image_labels_from_canvas_context(
-                    canvas_context_obj: dict | None, storyboard_label: str
-                ) -> list[str]:
-                    if not isinstance(canvas_context_obj, dict):
-                        return []
-                    nodes_ctx = canvas_context_obj.get("nodes")
-                    if not isinstance(nodes_ctx, list) or not nodes_ctx:
-                        return []
-                    # 1) Prefer the most recent successful storyboard image as continuity anchor (previous episode/segment).
-                    storyboard_anchor: str | None = None
-                    for n in reversed(nodes_ctx):
-                        if not isinstance(n, dict):
-                            continue
-                        label = n.get("label")
-                        if not isinstance(label, str) or not label.strip():
-                            continue
-                        label = label.strip()
-                        if label == storyboard_label:
-                            continue
-                        kind = n.get("kind") or n.get("type")
-                        if kind not in ("image", "textToImage", "mosaic"):
-                            continue
-                        if n.get("status") != "success":
-                            continue
-                        image_url = n.get("imageUrl")
-                        if not isinstance(image_url, str) or not image_url.strip():
-                            continue
-                        hint = f"{label}\n{n.get('promptPreview') or ''}"
-                        if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
-                            storyboard_anchor = label
-                            break
-
-                    # 2) Fill remaining slots with subject anchors (characters/products/key props),
-                    # excluding storyboard/video nodes to avoid over-weighting structure over subject identity.
-                    candidates: list[tuple[int, int, str]] = []
-                    for idx, n in enumerate(nodes_ctx):
-                        if not isinstance(n, dict):
-                            continue
-                        label = n.get("label")
-                        if not isinstance(label, str) or not label.strip():
-                            continue
-                        label = label.strip()
-                        if label == storyboard_label:
-                            continue
-                        kind = n.get("kind") or n.get("type")
-                        if kind not in ("image", "textToImage", "mosaic"):
-                            continue
-                        if n.get("status") != "success":
-                            continue
-                        image_url = n.get("imageUrl")
-                        if not isinstance(image_url, str) or not image_url.strip():
-                            continue
-                        if any(k in label for k in ("分镜", "九宫格", "storyboard", "视频", "15s视频")):
-                            continue
-                        score = 0
-                        if any(k in label for k in ("角色", "设定", "立绘", "主视觉", "character", "design")):
-                            score += 3
-                        # Products / key props hints
-                        if any(k in label for k in ("产品", "道具", "物件", "prop", "product")):
-                            score += 2
-                        if any(k in label.lower() for k in ("fox", "bunny", "rabbit")) or any(
-                            k in label for k in ("狐狸", "兔子")
-                        ):
-                            score += 2
-                        candidates.append((score, idx, label))
-                    candidates.sort(key=lambda t: (t[0], t[1]), reverse=True)
-                    picked: list[str] = []
-                    if storyboard_anchor:
-                        picked.append(storyboard_anchor)
-                    for _, _, label in candidates:
-                        if label in picked:
-                            continue
-                        picked.append(label)
-                        if len(picked) >= 3:
-                            break
-                    return picked[:3]
-
                 if wants_storyboard and isinstance(storyboard_image_label, str) and storyboard_image_label:
                     canvas_context_obj = state.get("canvas_context")
                     reference_labels = _pick_reference_image_labels_from_canvas_context(
@@ -2650,66 +3307,34 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                     # - panel-to-panel bridge frame (end pose/composition repeats at next start)
                     # - if previous storyboard is among references, continue from its final panel
                     try:
-                        for c in tool_calls_payload:
-                            if c.get("name") != "createNode":
+                        for v in calls:
+                            if v.name != "createNode" or v.type != "image" or v.label != storyboard_image_label:
                                 continue
-                            args = c.get("arguments") or {}
-                            if args.get("type") != "image":
-                                continue
-                            label = args.get("label")
-                            if not isinstance(label, str) or label.strip() != storyboard_image_label:
-                                continue
-                            cfg = args.get("config")
-                            if not isinstance(cfg, dict):
+                            cfg = v.cfg
+                            if cfg is None:
                                 continue
                             prompt_val = cfg.get("prompt")
                             if not isinstance(prompt_val, str) or not prompt_val.strip():
                                 continue
                             if "衔接帧" in prompt_val or "bridge frame" in prompt_val.lower():
                                 break
-                            continuity = (
-                                "\n\n连续性要求（很重要）：\n"
-                                "- 九宫格面板之间要有“衔接帧”感觉：面板N的结尾姿态/构图/机位/光线，应与面板N+1的开场保持一致（像同一动作的承接），避免突兀跳切。\n"
-                                "- 如果上游参考里包含上一张九宫格分镜图：请让本次面板1自然承接上一张的面板9（构图/主体位置/光线延续），再继续推进新内容。\n"
-                                "- 场景不要自由切换；主体数量不要在分镜中途增删。\n"
-                            )
-                            cfg["prompt"] = prompt_val.rstrip() + continuity
+                            cfg["prompt"] = prompt_val.rstrip() + _STORYBOARD_CONTINUITY_SUFFIX
                             break
                     except Exception:
                         pass
                     if reference_labels:
                         existing_pairs: set[tuple[str, str]] = set()
                         try:
-                            existing_pairs |= _canvas_existing_pairs_by_label(state.get("canvas_context"))
+                            if canvas_edge_pairs is None:
+                                canvas_edge_pairs = _canvas_existing_pairs_by_label(state.get("canvas_context"))
+                            existing_pairs |= canvas_edge_pairs
                         except Exception:
                             pass
-                        for c in tool_calls_payload:
-                            if c.get("name") != "connectNodes":
-                                continue
-                            args = c.get("arguments") or {}
-                            src = args.get("sourceNodeId") or args.get("sourceId")
-                            tgt = args.get("targetNodeId") or args.get("targetId")
-                            if isinstance(src, str) and isinstance(tgt, str):
-                                s = src.strip()
-                                t = tgt.strip()
-                                if s and t:
-                                    existing_pairs.add((s, t))
-
-                        create_idx = None
-                        run_idx = None
-                        for i, c in enumerate(tool_calls_payload):
-                            if c.get("name") == "createNode":
-                                args = c.get("arguments") or {}
-                                label = args.get("label")
-                                if isinstance(label, str) and label.strip() == storyboard_image_label:
-                                    create_idx = i
-                                    continue
-                            if c.get("name") == "runNode":
-                                args = c.get("arguments") or {}
-                                node_id = args.get("nodeId")
-                                if isinstance(node_id, str) and node_id.strip() == storyboard_image_label:
-                                    run_idx = i
-                                    break
+                        call_index = _ToolCallIndex(tool_calls_payload)
+                        existing_pairs |= call_index.connect_pairs
+
+                        create_idx = call_index.create_before_run(storyboard_image_label)
+                        run_idx = call_index.first_run(storyboard_image_label)
                         insert_at = run_idx if run_idx is not None else len(tool_calls_payload)
                         if create_idx is not None and insert_at <= create_idx:
                             insert_at = create_idx + 1
@@ -2734,28 +3359,17 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                             tool_calls_payload[insert_at:insert_at] = connect_calls
 
                 if wants_storyboard and storyboard_image_label and not has_compose_video:
-                    video_label = storyboard_image_label.replace("九宫格分镜", "15s视频").replace("分镜", "15s视频")
-                    if video_label == storyboard_image_label:
+                    if "分镜" in storyboard_image_label:
+                        video_label = _STORYBOARD_LABEL_WORD_RE.sub("15s视频", storyboard_image_label)
+                    else:
                         video_label = f"{storyboard_image_label}-15s视频"
                     storyboard_hint = ""
                     if isinstance(storyboard_image_prompt, str) and storyboard_image_prompt.strip():
-                        normalized = "\n".join(
-                            [ln.strip() for ln in storyboard_image_prompt.strip().splitlines() if ln.strip()]
-                        )
+                        normalized = "\n".join([ln for ln in map(str.strip, storyboard_image_prompt.splitlines()) if ln])
                         if len(normalized) > 1200:
                             normalized = normalized[:1200].rstrip() + "…"
-                        storyboard_hint = (
-                            "\n\n分镜补充（来自九宫格分镜的镜头描述，用于动作/镜头节奏对齐；以参考图为准）：\n"
-                            + normalized
-                        )
-                    video_prompt = (
-                        "根据上游参考图片（九宫格分镜图）生成一个15秒的二维动画视频：\n"
-                        "- 画面风格/角色外观严格跟随参考图；不要改变角色造型与配色。\n"
-                        "- 按参考图的镜头节奏推进（从1到9），镜头之间自然衔接；保持同一场景光线连续。\n"
-                        "- 不要出现任何可读文字/水印/Logo。\n"
-                        "- 输出16:9，动作清晰，镜头稳定，节奏温暖治愈。"
-                        + storyboard_hint
-                    )
+                        storyboard_hint = _STORYBOARD_VIDEO_HINT_HEADER + normalized
+                    video_prompt = _STORYBOARD_VIDEO_PROMPT + storyboard_hint
                     tool_calls_payload.append(
                         {
                             "id": f"auto_create_video_{video_label}",
@@ -2787,37 +3401,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
 
                 # General continuity: if the user asks to base new content on existing results (基于/续写/同款/延展),
                 # ensure newly created image nodes are connected to a relevant upstream image before running.
-                reference_intent = any(
-                    kw in (last_user_text or "")
-                    for kw in ("基于", "同款", "同风格", "沿用", "续写", "延展", "变体", "参考", "保持一致")
-                )
-
-                def _pick_latest_success_image_label(canvas_context_obj: dict | None) -> str | None:
-                    if not isinstance(canvas_context_obj, dict):
-                        return None
-                    nodes_ctx = canvas_context_obj.get("nodes")
-                    if not isinstance(nodes_ctx, list) or not nodes_ctx:
-                        return None
-                    # iterate from latest to oldest
-                    for n in reversed(nodes_ctx):
-                        if not isinstance(n, dict):
-                            continue
-                        kind = n.get("kind") or n.get("type")
-                        if kind not in ("image", "textToImage", "mosaic"):
-                            continue
-                        if n.get("status") != "success":
-                            continue
-                        label = n.get("label")
-                        if not isinstance(label, str) or not label.strip():
-                            continue
-                        label = label.strip()
-                        if any(k in label for k in ("分镜", "九宫格", "storyboard")):
-                            continue
-                        image_url = n.get("imageUrl")
-                        if not isinstance(image_url, str) or not image_url.strip():
-                            continue
-                        return label
-                    return None
+                reference_intent = bool(gate_flags & _GATE_REFERENCE_INTENT)
 
                 if reference_intent:
                     canvas_context_obj = state.get("canvas_context")
@@ -2827,42 +3411,32 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                         existing_pairs: set[tuple[str, str]] = set()
                         existing_targets: set[str] = set()
                         try:
-                            existing_pairs |= _canvas_existing_pairs_by_label(state.get("canvas_context"))
-                            for _, t in existing_pairs:
-                                existing_targets.add(t)
+                            if canvas_edge_pairs is None:
+                                canvas_edge_pairs = _canvas_existing_pairs_by_label(state.get("canvas_context"))
+                            existing_pairs |= canvas_edge_pairs
+                            existing_targets.update(t for _, t in canvas_edge_pairs)
                         except Exception:
                             pass
-                        for c in tool_calls_payload:
-                            if c.get("name") != "connectNodes":
-                                continue
-                            args = c.get("arguments") or {}
-                            src = args.get("sourceNodeId") or args.get("sourceId")
-                            tgt = args.get("targetNodeId") or args.get("targetId")
-                            if isinstance(src, str) and isinstance(tgt, str):
-                                s = src.strip()
-                                t = tgt.strip()
-                                if s and t:
-                                    existing_pairs.add((s, t))
-                                    existing_targets.add(t)
+                        call_index = _ToolCallIndex(tool_calls_payload)
+                        planned_pairs = call_index.connect_pairs
+                        existing_pairs |= planned_pairs
+                        existing_targets.update(t for _, t in planned_pairs)
 
                         # For each newly created image node, if it has no inbound connection yet, add one.
+                        # Indices below are from the snapshot; inserted_at records where connects went so
+                        # snapshot positions can be mapped onto the live (growing) payload.
+                        inserted_at: list[int] = []
                         for idx, c in enumerate(list(tool_calls_payload)):
                             if c.get("name") != "createNode":
                                 continue
-                            args = c.get("arguments") or {}
-                            if args.get("type") != "image":
+                            v = _NormCall(c)
+                            if v.type != "image" or not v.label:
                                 continue
-                            label = args.get("label")
-                            if not isinstance(label, str) or not label.strip():
-                                continue
-                            target_label = label.strip()
+                            target_label = v.label
                             if target_label == upstream_label:
                                 continue
                             # Skip storyboard grid; it has its own multi-reference logic above.
-                            cfg = args.get("config") or {}
-                            prompt = cfg.get("prompt") if isinstance(cfg, dict) else ""
-                            hint = f"{target_label}\n{prompt}"
-                            if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
+                            if v.storyboard_hint():
                                 continue
                             if target_label in existing_targets:
                                 continue
@@ -2870,14 +3444,15 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                                 continue
 
                             # Insert before the runNode(target) if present, otherwise right after createNode.
+                            # Inserted calls are never runNode, so the first run of target_label whose live
+                            # position is past idx is what a forward scan of the live payload would find.
                             insert_at = idx + 1
-                            for j in range(idx + 1, len(tool_calls_payload)):
-                                tc = tool_calls_payload[j]
-                                if tc.get("name") != "runNode":
-                                    continue
-                                nid = (tc.get("arguments") or {}).get("nodeId")
-                                if isinstance(nid, str) and nid.strip() == target_label:
-                                    insert_at = j
+                            for run_pos in call_index.runs_at.get(target_label, ()):
+                                for p in inserted_at:
+                                    if p <= run_pos:
+                                        run_pos += 1
+                                if run_pos > idx:
+                                    insert_at = run_pos
                                     break
                             tool_calls_payload.insert(
                                 insert_at,
@@ -2892,63 +3467,33 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                                     },
                                 },
                             )
+                            inserted_at.append(insert_at)
                             existing_targets.add(target_label)
 
                 # If this response sets up an image->video storyboard workflow, avoid prematurely running video.
-                created_image_labels: set[str] = set()
-                created_video_labels: set[str] = set()
-                for call in tool_calls_payload:
-                    if call.get("name") != "createNode":
-                        continue
-                    args = call.get("arguments") or {}
-                    node_type = args.get("type")
-                    label = args.get("label")
-                    if not isinstance(label, str) or not label.strip():
-                        continue
-                    if node_type in ("image", "textToImage"):
-                        created_image_labels.add(label.strip())
-                    if node_type == "composeVideo":
-                        created_video_labels.add(label.strip())
-
-                if created_image_labels and created_video_labels:
+                # One pass over the final payload collects both label sets and the running nodes; the
+                # run filter below only drops runNode calls, so the created labels stay valid.
+                call_index = _ToolCallIndex(tool_calls_payload)
+                created_labels = call_index.image_labels
+                created_video_labels = call_index.video_labels
+                already_running = set(call_index.runs_at)
+
+                # Rebuild the payload only when one of the new videos is actually being run.
+                premature_video_runs = already_running.intersection(created_video_labels) if created_labels else set()
+                if premature_video_runs:
                     tool_calls_payload[:] = [
-                        c
-                        for c in tool_calls_payload
-                        if not (
-                            c.get("name") == "runNode"
-                            and isinstance((c.get("arguments") or {}).get("nodeId"), str)
-                            and (c.get("arguments") or {}).get("nodeId").strip() in created_video_labels
-                        )
+                        c for c in tool_calls_payload if _run_target(c) not in premature_video_runs
                     ]
-
-                created_labels: list[str] = []
-                already_running: set[str] = set()
-                for call in tool_calls_payload:
-                    if call.get("name") == "runNode":
-                        args = call.get("arguments") or {}
-                        node_id = args.get("nodeId")
-                        if isinstance(node_id, str) and node_id.strip():
-                            already_running.add(node_id.strip())
-                    if call.get("name") == "createNode":
-                        args = call.get("arguments") or {}
-                        node_type = args.get("type")
-                        label = args.get("label")
-                        if (
-                            node_type in ("image", "textToImage")
-                            and isinstance(label, str)
-                            and label.strip()
-                        ):
-                            created_labels.append(label.strip())
-                for label in created_labels:
-                    if label in already_running:
-                        continue
-                    tool_calls_payload.append(
-                        {
-                            "id": f"auto_run_{label}",
-                            "name": "runNode",
-                            "arguments": {"nodeId": label},
-                        }
-                    )
+                    already_running -= premature_video_runs
+                tool_calls_payload.extend(
+                    {
+                        "id": f"auto_run_{label}",
+                        "name": "runNode",
+                        "arguments": {"nodeId": label},
+                    }
+                    for label in created_labels
+                    if label not in already_running
+                )
             result = AIMessage(content=result_text)
         except ValueError as exc:
             debug_openai_error("finalize_answer", exc)
@@ -2956,7 +3501,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             result = AIMessage(
                 content="无法生成最终答案：后端未配置模型密钥（请检查 OPENAI_API_KEY / GEMINI_API_KEY）。"
             )
-        except (APIConnectionError, OpenAIError) as exc:
+        except (_openai_mod().APIConnectionError, _openai_mod().OpenAIError) as exc:
             debug_openai_error("finalize_answer", exc)
             llm_error_payload = _format_openai_error(exc)
             result = AIMessage(
@@ -2968,12 +3513,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             result = AIMessage(content="无法生成最终答案：运行时异常。")
     else:
         # init Reasoning Model, default to Gemini 2.5 Flash
-        llm = ChatGoogleGenerativeAI(
-            model=reasoning_model,
-            temperature=0,
-            max_retries=2,
-            api_key=get_gemini_api_key(),
-        )
+        llm = _gemini_chat(reasoning_model)
         result = llm.invoke(formatted_prompt)
 
     # Replace the short urls with the original urls and add all used urls to the sources_gathered
@@ -2988,31 +3528,13 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
     # If the model didn't provide quick replies, synthesize a few safe next-step options.
     if tool_calls_payload:
         try:
-            created_images: list[str] = []
-            created_videos: list[str] = []
-            ran_nodes: set[str] = set()
-            for call in tool_calls_payload:
-                name = call.get("name")
-                args = call.get("arguments") or {}
-                if name == "createNode":
-                    label = args.get("label")
-                    node_type = args.get("type")
-                    if isinstance(label, str) and label.strip():
-                        label = label.strip()
-                        if node_type in ("image", "textToImage"):
-                            created_images.append(label)
-                        if node_type == "composeVideo":
-                            created_videos.append(label)
-                if name == "runNode":
-                    node_id = args.get("nodeId")
-                    if isinstance(node_id, str) and node_id.strip():
-                        ran_nodes.add(node_id.strip())
-
             if not quick_replies_payload:
+                call_index = _ToolCallIndex(tool_calls_payload)
+                created_images = call_index.image_labels
                 actions: list[dict] = []
                 # If we created a video node but didn't run it (common storyboard flow), offer to run it next.
-                for v in created_videos:
-                    if v in ran_nodes:
+                for v in call_index.video_labels:
+                    if v in call_index.runs_at:
                         continue
                     actions.append(
                         {
@@ -3046,12 +3568,15 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             # best-effort only
             pass
     for source in state["sources_gathered"]:
-        if source["short_url"] in content:
-            content = content.replace(source["short_url"], source["value"])
+        short_url = source["short_url"]
+        if short_url in content:
+            # KB sources use the real URL as their short_url; only rewrite when they differ.
+            if source["value"] != short_url:
+                content = content.replace(short_url, source["value"])
             unique_sources.append(source)
 
     # Normalize content/tool calls
-    tool_calls_payload = locals().get("tool_calls_payload", []) or []
+    tool_calls_payload = tool_calls_payload or []
 
     message_kwargs = {
         "active_role": resolved_id,
@@ -3100,48 +3625,93 @@ def direct_answer(state: OverallState, config: RunnableConfig):
     state.setdefault("sources_gathered", [])
     return finalize_answer(state, config)
 
-@traceable
-def kb_retrieve(state: OverallState, config: RunnableConfig) -> OverallState:
-    """Optional knowledge-base retrieval (e.g. Cloudflare AutoRAG) to ground the answer."""
-    configurable = Configuration.from_runnable_config(config)
+
+def _kb_retrieve_queries(state: OverallState, configurable: Configuration) -> list[str]:
+    """Return the AutoRAG queries to issue for this turn (empty when retrieval should be skipped)."""
     # This project uses RAG on-demand only (never external web search).
     requested_tier = (state.get("active_tool_tier") or "").strip().lower()
     if requested_tier != "rag":
-        return {}
+        return []
     started_at = state.get("request_started_at")
     if isinstance(started_at, (int, float)):
         if (time.monotonic() - started_at) >= REQUEST_TIMEOUT_SECONDS:
-            return {}
+            return []
 
     # Build a compact summary query to avoid sending full thread history.
     query = _build_autorag_query(state).strip()
     if not query:
-        return {}
+        return []
 
     # Allow RAG retrieval even when search_provider is "disabled", as long as AutoRAG is configured.
     provider = (configurable.search_provider or "").strip().lower()
     if provider not in ("", "disabled", "autorag"):
-        return {}
+        return []
+    return [query]
 
-    snippets, sources = _call_autorag_search(configurable, query)
+
+def _kb_retrieve_update(
+    queries: list[str], results: list[tuple[list[str], list[dict]]]
+) -> OverallState:
+    """Merge per-query AutoRAG results into a state update."""
+    snippets: list[str] = []
+    sources: list[dict] = []
+    for query_snippets, query_sources in results:
+        snippets.extend(query_snippets)
+        sources.extend(query_sources or [])
     if not snippets:
         return {}
     return {
-        "search_query": [query],
+        "search_query": queries,
         "web_research_result": snippets,
-        "sources_gathered": sources or [],
+        "sources_gathered": sources,
     }
 
+
+@traceable
+def kb_retrieve(state: OverallState, config: RunnableConfig) -> OverallState:
+    """Optional knowledge-base retrieval (e.g. Cloudflare AutoRAG) to ground the answer."""
+    configurable = Configuration.from_runnable_config(config)
+    queries = _kb_retrieve_queries(state, configurable)
+    if not queries:
+        return {}
+    return _kb_retrieve_update(queries, [_call_autorag_search(configurable, q) for q in queries])
+
+
+@traceable
+async def akb_retrieve(state: OverallState, config: RunnableConfig) -> OverallState:
+    """Async kb_retrieve: same queries as kb_retrieve, without blocking the event loop."""
+    configurable = Configuration.from_runnable_config(config)
+    queries = _kb_retrieve_queries(state, configurable)
+    if not queries:
+        return {}
+    return _kb_retrieve_update(queries, [await _call_autorag_search_async(configurable, q) for q in queries])
+
+
 builder.add_node("direct_answer", direct_answer)
-builder.add_node("kb_retrieve", kb_retrieve)
+# Sync callers (graph.invoke) use kb_retrieve; the LangGraph server runs the async variant.
+builder.add_node("kb_retrieve", RunnableLambda(kb_retrieve, afunc=akb_retrieve, name="kb_retrieve"))
+
+
+_MEMORY_COMPRESSOR_INSTRUCTIONS = (
+    "You are a background memory compressor for a creative assistant.\n"
+    "Goal: produce a compact, durable conversation summary that preserves user intent, preferences, constraints,\n"
+    "project/canvas facts, and any decisions. This summary will be injected into future prompts.\n"
+    "Rules:\n"
+    "- Output plain text only (no markdown fences).\n"
+    "- Max 1800 characters.\n"
+    "- Prefer stable facts over transient chatter.\n"
+    "- Keep named entities, style locks, and any explicit constraints.\n"
+    "- If there is a previous summary, update it incrementally; do not rewrite from scratch unless necessary.\n\n"
+)
 
 
 @traceable
 def summarize_memory(state: OverallState, config: RunnableConfig) -> OverallState:
     """Best-effort conversation summarization to keep long threads compact.
 
-    This runs after answering. The summary is returned in `conversation_summary` and can be
-    persisted by the frontend (e.g. in D1) to survive thread expiry/restarts.
+    This runs alongside `direct_answer` (both fan out from `kb_retrieve`), so it sees the
+    thread up to the current user turn. The summary is returned in `conversation_summary` and
+    can be persisted by the frontend (e.g. in D1) to survive thread expiry/restarts.
     """
     try:
         messages = state.get("messages") or []
@@ -3151,16 +3721,12 @@ def summarize_memory(state: OverallState, config: RunnableConfig) -> OverallStat
         tail_keep = 16
         if len(messages) <= tail_keep:
             return {}
-        rendered = format_messages_for_prompt(messages)
         # Trigger only when the serialized history becomes large.
+        # Still allow a first-time summary when the conversation is moderately long.
         trigger_chars = 120_000
-        if isinstance(rendered, str) and len(rendered) < trigger_chars:
-            # Still allow a first-time summary when the conversation is moderately long.
-            if not (isinstance(state.get("conversation_summary"), str) and state.get("conversation_summary").strip()):
-                if len(messages) < 40:
-                    return {}
-            else:
-                return {}
+        has_summary = isinstance(state.get("conversation_summary"), str) and state.get("conversation_summary").strip()
+        if (has_summary or len(messages) < 40) and formatted_messages_length(messages) < trigger_chars:
+            return {}
 
         configurable = Configuration.from_runnable_config(config)
         llm_provider = resolve_llm_provider(configurable.llm_provider)
@@ -3168,18 +3734,9 @@ def summarize_memory(state: OverallState, config: RunnableConfig) -> OverallStat
         prev = state.get("conversation_summary") or ""
         older = format_messages_for_prompt(messages[:-tail_keep])
         recent = format_messages_for_prompt(messages[-tail_keep:])
-        canvas_context = state.get("canvas_context")
-        canvas_context_text = _render_canvas_context_for_prompt(canvas_context)
+        canvas_context_text = _canvas_context_text(state)
         prompt = (
-            "You are a background memory compressor for a creative assistant.\n"
-            "Goal: produce a compact, durable conversation summary that preserves user intent, preferences, constraints,\n"
-            "project/canvas facts, and any decisions. This summary will be injected into future prompts.\n"
-            "Rules:\n"
-            "- Output plain text only (no markdown fences).\n"
-            "- Max 1800 characters.\n"
-            "- Prefer stable facts over transient chatter.\n"
-            "- Keep named entities, style locks, and any explicit constraints.\n"
-            "- If there is a previous summary, update it incrementally; do not rewrite from scratch unless necessary.\n\n"
+            f"{_MEMORY_COMPRESSOR_INSTRUCTIONS}"
             f"CANVAS_CONTEXT:\n{canvas_context_text}\n\n"
             f"PREVIOUS_SUMMARY:\n{str(prev).strip()}\n\n"
             f"OLDER_MESSAGES_TO_COMPRESS:\n{older}\n\n"
@@ -3192,7 +3749,7 @@ def summarize_memory(state: OverallState, config: RunnableConfig) -> OverallStat
             try:
                 response = client.responses.create(
                     model=model,
-                    input=[{"role": "user", "content": [{"type": "input_text", "text": prompt}]}],
+                    input=_responses_input(prompt),
                     stream=True,
                 )
                 debug_openai_response("summarize_memory", response)
@@ -3201,18 +3758,13 @@ def summarize_memory(state: OverallState, config: RunnableConfig) -> OverallStat
                 debug_openai_error("summarize_memory responses_fallback", exc)
                 chat = client.chat.completions.create(
                     model=model,
-                    messages=[{"role": "user", "content": prompt}],
+                    messages=_chat_messages(prompt),
                     temperature=0,
                 )
                 msg = chat.choices[0].message
                 new_summary = str(getattr(msg, "content", "") or "")
         else:
-            llm = ChatGoogleGenerativeAI(
-                model=model,
-                temperature=0,
-                max_retries=2,
-                api_key=get_gemini_api_key(),
-            )
+            llm = _gemini_chat(model)
             new_summary = str(llm.invoke(prompt).content or "")
 
         if not isinstance(new_summary, str):
@@ -3230,11 +3782,13 @@ def summarize_memory(state: OverallState, config: RunnableConfig) -> OverallStat
 
 builder.add_node("summarize_memory", summarize_memory)
 
-# Entrypoint: role selection then direct answer (no web search)
+# Entrypoint: role selection then direct answer (no web search).
+# Memory summarization only writes `conversation_summary`, so it runs in parallel with the answer.
 builder.add_edge(START, "select_role")
 builder.add_edge("select_role", "kb_retrieve")
 builder.add_edge("kb_retrieve", "direct_answer")
-builder.add_edge("direct_answer", "summarize_memory")
+builder.add_edge("kb_retrieve", "summarize_memory")
+builder.add_edge("direct_answer", END)
 builder.add_edge("summarize_memory", END)
 
 graph = builder.compile(name="animation-agent")
@@ -1,9 +1,15 @@
-from datetime import datetime
+from datetime import date
+from functools import lru_cache
 
 
-# Get current date in a readable format
+@lru_cache(maxsize=2)
+def _format_date(day: date) -> str:
+    return day.strftime("%B %d, %Y")
+
+
+# Get current date in a readable format (formatted once per day)
 def get_current_date():
-    return datetime.now().strftime("%B %d, %Y")
+    return _format_date(date.today())
 
 
 role_router_instructions = """You are an intent router that picks exactly one assistant role for the next reply.
@@ -37,8 +43,6 @@ Canvas context (optional, JSON):
 answer_instructions = """Generate a high-quality answer to the user's question based on the provided summaries.
 
 Instructions:
-- The current date is {current_date}.
-- Interaction mode is {interaction_mode} (one of "plan", "agent", "agent_max").
 - You are the final step of a multi-step research process, don't mention that you are the final step. 
 - You have access to all the information gathered from the previous steps.
 - You have access to the user's question.
@@ -111,6 +115,8 @@ Instructions:
   - When generating a 3x3 storyboard, ensure shot-to-shot continuity: the end pose/composition of panel N should match the start of panel N+1 (a repeated “bridge frame” feel), and if a previous storyboard exists in references, panel 1 should naturally continue from the previous storyboard’s final panel.
 
 User Context:
+- The current date is {current_date}.
+- Interaction mode is {interaction_mode} (one of "plan", "agent", "agent_max").
 - {research_topic}
 
 Active Role:
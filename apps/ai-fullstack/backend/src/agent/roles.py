@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from typing import Dict, List
 
 Role = Dict[str, str]
@@ -59,14 +60,18 @@ ROLE_DEFINITIONS: List[Role] = [
 DEFAULT_ROLE_ID = "art_director"
 
 
+_ROLE_IDS = frozenset(role["id"] for role in ROLE_DEFINITIONS)
+
+
 def role_map() -> Dict[str, Role]:
     """Return a lookup map keyed by role id."""
     return {role["id"]: role for role in ROLE_DEFINITIONS}
 
 
+@lru_cache(maxsize=64)
 def normalize_role_id(role_id: str) -> str:
     """Ensure the selected role id exists, otherwise fall back to the default."""
-    if role_id in role_map():
+    if role_id in _ROLE_IDS:
         return role_id
     return DEFAULT_ROLE_ID
 
@@ -31,3 +31,5 @@ class OverallState(TypedDict):
     research_loop_count: int
     reasoning_model: str
     canvas_context: dict
+    # Prompt rendering of canvas_context, produced once per turn by select_role.
+    canvas_context_text: NotRequired[str]
@@ -19,20 +19,30 @@ def get_research_topic(messages: List[AnyMessage]) -> str:
     return research_topic
 
 
+def _message_role(message: AnyMessage) -> str:
+    if isinstance(message, HumanMessage):
+        return "User"
+    if isinstance(message, AIMessage):
+        return "Assistant"
+    if isinstance(message, SystemMessage):
+        return "System"
+    return f"{getattr(message, 'type', 'Message')}"
+
+
 def format_messages_for_prompt(messages: List[AnyMessage]) -> str:
     """Render chat history into a compact role-labeled string for prompts."""
-    rendered = []
+    return "\n".join([f"{_message_role(message)}: {message.content}" for message in messages])
+
+
+def formatted_messages_length(messages: List[AnyMessage]) -> int:
+    """Return len(format_messages_for_prompt(messages)) without building the string."""
+    if not messages:
+        return 0
+    total = len(messages) - 1
     for message in messages:
-        if isinstance(message, HumanMessage):
-            role = "User"
-        elif isinstance(message, AIMessage):
-            role = "Assistant"
-        elif isinstance(message, SystemMessage):
-            role = "System"
-        else:
-            role = getattr(message, "type", "Message")
-        rendered.append(f"{role}: {message.content}")
-    return "\n".join(rendered)
+        content = message.content
+        total += len(_message_role(message)) + 2 + len(content if isinstance(content, str) else f"{content}")
+    return total
 
 
 def resolve_urls(urls_to_resolve: List[Any], id: int) -> Dict[str, str]:
@@ -0,0 +1,100 @@
+import importlib
+import random
+
+import pytest
+
+graph = importlib.import_module("agent.graph")
+
+
+def _reference_flags(groups: dict[int, tuple[str, ...]], text: str) -> int:
+    bits = 0
+    for bit, keywords in groups.items():
+        if any(k in text for k in keywords):
+            bits |= bit
+    return bits
+
+
+@pytest.mark.parametrize(
+    ("groups", "text"),
+    [
+        ({1: ("ab",), 2: ("cb",), 4: ("ac", "baa"), 8: ("cbc",)}, "acbaa"),
+        ({1: ("c", "ba"), 2: ("ccba", "ab", "bb"), 4: ("bcbc",), 8: ("c", "cc")}, "cccba"),
+        ({1: ("继续",), 2: ("续写",)}, "继续写"),
+    ],
+)
+def test_compile_keyword_gates_matches_overlapping_keywords(groups, text):
+    assert graph._compile_keyword_gates(groups)(text) == _reference_flags(groups, text)
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ("帮我续写一下，推荐几个方向", graph._GATE_SUGGEST_CONTINUE | graph._GATE_SUGGEST_ASK | graph._GATE_CONTINUATION_STEP | graph._GATE_REFERENCE_INTENT),
+        ("生成九宫格分镜图", graph._GATE_STORYBOARD_WORDS | graph._GATE_STORYBOARD_REQUEST | graph._GATE_GENERATE_VERB | graph._GATE_GENERATE_OUTPUT),
+        ("做成15秒视频", graph._GATE_GENERATE_VERB | graph._GATE_GENERATE_OUTPUT),
+        ("确认锁定风格：水墨", graph._GATE_LOCK_EXPLICIT),
+        ("就按这个，直接生成", graph._GATE_LOCK_IMPLICIT | graph._GATE_GENERATE_VERB),
+        ("我选择方向 2", graph._GATE_CONTINUATION_STEP | graph._GATE_SUGGEST_ASK),
+        ("先不操作画布，只聊剧情", graph._GATE_CANVAS_OPT_OUT),
+        ("参考上一张图做同款", graph._GATE_REFERENCE_INTENT),
+        ("你好", 0),
+        ("", 0),
+    ],
+)
+def test_user_gate_flags(text, expected):
+    assert graph._user_gate_flags(text) == expected
+
+
+# Inline checks finalize_answer used before these two gates joined the bitmask.
+def _old_canvas_opt_out(text: str) -> bool:
+    return any(k in text for k in ("先不操作画布", "不要操作画布", "只聊", "只写", "不要生成", "不生成"))
+
+
+def _old_reference_intent(text: str) -> bool:
+    return any(kw in text for kw in ("基于", "同款", "同风格", "沿用", "续写", "延展", "变体", "参考", "保持一致"))
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "先不操作画布，只聊剧情",
+        "不要生成图片，只写剧本",
+        "请不生成任何节点",
+        "基于上一张图做同风格的变体",
+        "沿用主角设定，保持一致",
+        "继续写下去并延展世界观",
+        "参考这张图生成九宫格分镜",
+        "生成一张新图",
+        "你好",
+        "",
+    ],
+)
+def test_canvas_opt_out_and_reference_intent_match_inline_checks(text):
+    flags = graph._user_gate_flags(text)
+    assert bool(flags & graph._GATE_CANVAS_OPT_OUT) == _old_canvas_opt_out(text)
+    assert bool(flags & graph._GATE_REFERENCE_INTENT) == _old_reference_intent(text)
+
+
+_USER_GATES = {
+    graph._GATE_SUGGEST_CONTINUE: graph._STORY_SUGGEST_CONTINUE_KEYWORDS,
+    graph._GATE_SUGGEST_ASK: graph._STORY_SUGGEST_ASK_KEYWORDS,
+    graph._GATE_STORYBOARD_WORDS: graph._STORY_SUGGEST_EXCLUDE_KEYWORDS,
+    graph._GATE_STORYBOARD_REQUEST: graph._STORYBOARD_REQUEST_KEYWORDS,
+    graph._GATE_GENERATE_VERB: graph._GENERATE_VERB_KEYWORDS,
+    graph._GATE_GENERATE_OUTPUT: graph._GENERATE_OUTPUT_KEYWORDS,
+    graph._GATE_LOCK_EXPLICIT: graph._LOCK_EXPLICIT_KEYWORDS,
+    graph._GATE_LOCK_IMPLICIT: graph._LOCK_IMPLICIT_KEYWORDS,
+    graph._GATE_CONTINUATION_STEP: graph._CONTINUATION_STEP_KEYWORDS,
+    graph._GATE_CANVAS_OPT_OUT: graph._CANVAS_OPT_OUT_KEYWORDS,
+    graph._GATE_REFERENCE_INTENT: graph._REFERENCE_INTENT_KEYWORDS,
+}
+
+
+def test_user_gate_flags_match_substring_checks_on_keyword_mixes():
+    rng = random.Random(0)
+    keywords = sorted({k for group in _USER_GATES.values() for k in group})
+    # Keyword fragments make partial and overlapping matches likely.
+    pieces = keywords + [k[: len(k) // 2] for k in keywords] + [k[len(k) // 2 :] for k in keywords] + ["，", " ", "x"]
+    for _ in range(5000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 6)))
+        assert graph._user_gate_flags(text) == _reference_flags(_USER_GATES, text), text
@@ -0,0 +1,61 @@
+import contextvars
+import importlib
+
+graph = importlib.import_module("agent.graph")
+SafetyDecision = importlib.import_module("agent.tools_and_schemas").SafetyDecision
+
+_marker: contextvars.ContextVar[str] = contextvars.ContextVar("marker", default="")
+
+
+def _decision(**flags) -> SafetyDecision:
+    values = dict(sexual=False, nudity=False, gore=False, violence=False, should_block=False, should_sanitize=False)
+    values.update(flags)
+    return SafetyDecision(reason="test", **values)
+
+
+def test_prefetch_runs_classifier_with_caller_context(monkeypatch):
+    seen = []
+
+    def fake_structured(model, prompt, schema_model):
+        seen.append((model, schema_model, _marker.get(), "USER_TEXT:\n画一只狐狸" in prompt))
+        return _decision(violence=True)
+
+    monkeypatch.setattr(graph, "_call_openai_structured", fake_structured)
+    _marker.set("caller")
+    result = graph._prefetch_safety_decision("safety-model", "画一只狐狸").result(timeout=5)
+    assert result.violence is True
+    assert seen == [("safety-model", SafetyDecision, "caller", True)]
+
+
+def test_classify_safety_uses_prefetch_only_without_planned_prompts(monkeypatch):
+    calls = []
+
+    def fake_structured(model, prompt, schema_model):
+        calls.append(prompt)
+        return _decision(should_sanitize=True)
+
+    monkeypatch.setattr(graph, "_call_openai_structured", fake_structured)
+    prefetched = graph._SAFETY_EXECUTOR.submit(_decision, gore=True)
+
+    assert graph._classify_safety("m", prefetched, "text", "").gore is True
+    assert calls == []
+
+    assert graph._classify_safety("m", prefetched, "text", "planned prompt").should_sanitize is True
+    assert len(calls) == 1 and "planned prompt" in calls[0]
+
+
+def test_classify_safety_skips_empty_input(monkeypatch):
+    monkeypatch.setattr(graph, "_call_openai_structured", lambda *a: (_ for _ in ()).throw(AssertionError("called")))
+    first = graph._classify_safety("m", None, "  ", "")
+    first.should_block = True
+    second = graph._classify_safety("m", None, "", "\n")
+    assert second.should_block is False and second.should_sanitize is False
+
+
+def test_classify_safety_falls_back_to_sanitize_on_error(monkeypatch):
+    def boom(*args):
+        raise RuntimeError("classifier down")
+
+    monkeypatch.setattr(graph, "_call_openai_structured", boom)
+    result = graph._classify_safety("m", None, "text", "")
+    assert result.should_block is False and result.should_sanitize is True
@@ -0,0 +1,70 @@
+import importlib
+import math
+
+import pytest
+
+graph = importlib.import_module("agent.graph")
+
+
+def _create(label: str, **args) -> dict:
+    return {"name": "createNode", "arguments": {"label": label, **args}}
+
+
+def test_filter_tool_calls_drops_exact_duplicates():
+    calls = [
+        _create("A", type="image", config={"prompt": "p", "kind": "image"}),
+        # Same arguments in a different key order are still a duplicate.
+        {"name": "createNode", "arguments": {"config": {"kind": "image", "prompt": "p"}, "type": "image", "label": "A"}},
+        _create("B", type="image"),
+        {"name": "runNode", "arguments": {"nodeId": "A"}},
+        {"name": "runNode", "arguments": {"nodeId": "A"}},
+    ]
+    filtered = graph._filter_tool_calls_by_role(calls, "storyboard_artist", True)
+    assert filtered == [calls[0], calls[2], calls[3]]
+
+
+def test_filter_tool_calls_respects_role_and_gate():
+    calls = [_create("A"), {"name": "deleteNode", "arguments": {"nodeId": "A"}}, "not a call"]
+    assert graph._filter_tool_calls_by_role(calls, "storyboard_artist", True) == [calls[0]]
+    assert graph._filter_tool_calls_by_role(calls, "screenwriter", True) == []
+    assert graph._filter_tool_calls_by_role(calls, "storyboard_artist", False) == []
+
+
+def test_filter_tool_calls_keeps_calls_with_unserializable_arguments():
+    calls = [{"name": "createNode", "arguments": {"tags": {1, 2}}}] * 2
+    assert graph._filter_tool_calls_by_role(calls, "storyboard_artist", True) == calls
+
+
+@pytest.mark.parametrize(
+    ("cfg", "expected"),
+    [
+        ({"videoDurationSeconds": 12}, 12),
+        ({"durationSeconds": 12.6}, 13),
+        ({"duration": 5}, 10),
+        ({"videoDurationSeconds": 30}, 15),
+        ({"videoModel": "MiniMax-Hailuo-02", "duration": 7}, 6),
+        ({"videoModelVendor": "minimax", "duration": 9}, 10),
+        ({"videoModel": "i2v-01", "duration": 30}, 10),
+    ],
+)
+def test_clamp_compose_video_duration(cfg, expected):
+    graph._clamp_compose_video_duration(cfg)
+    assert cfg["videoDurationSeconds"] == cfg["durationSeconds"] == expected
+
+
+def test_clamp_compose_video_duration_adds_part_one_hint_once():
+    cfg = {"duration": 30, "prompt": "雨夜追逐  "}
+    graph._clamp_compose_video_duration(cfg)
+    assert cfg["prompt"] == "雨夜追逐" + graph._VIDEO_PART_ONE_HINT
+
+    segmented = {"duration": 30, "prompt": "第1段，分段生成"}
+    graph._clamp_compose_video_duration(segmented)
+    assert segmented["prompt"] == "第1段，分段生成"
+
+
+@pytest.mark.parametrize("cfg", [{}, {"duration": "15"}, {"duration": math.nan}])
+def test_clamp_compose_video_duration_leaves_unusable_values(cfg):
+    before = dict(cfg)
+    graph._clamp_compose_video_duration(cfg)
+    assert "videoDurationSeconds" not in cfg
+    assert cfg.keys() == before.keys()